@@ -26,6 +26,7 @@
 from __future__ import unicode_literals
 from past.builtins import basestring
 from builtins import object
+from builtins import range
 
 from collections import namedtuple
 import operator
@@ -40,6 +41,8 @@ from .model import (
     CodeFunctionCall, CodeOperator, CodeReference, CodeVariable, CodeLoop,
     CodeDefaultArgument, CodeClass
 )
+from .cfg import get_cfg
+from .dataflow import get_def_use
 
 
 ###############################################################################
@@ -217,17 +220,10 @@ def resolve_reference(reference):
             if var.is_parameter:
                 if _get_function(var) is not function:
                     return None
-                calls = [call for call in function.references
-                         if isinstance(call, CodeFunctionCall)]
-                if len(calls) != 1:
+                summary = get_parameter_summary(function)
+                if summary is None:
                     return None
-                i = function.parameters.index(var)
-                if len(calls[0].arguments) <= i:
-                    return None
-                arg = calls[0].arguments[i]
-                if isinstance(arg, CodeReference):
-                    return resolve_reference(arg)
-                return arg
+                return summary.value(function.parameters.index(var))
             if var.member_of is not None:
                 if (function.is_constructor
                         and function.member_of is var.member_of):
@@ -244,6 +240,133 @@ def resolve_reference(reference):
     return reference.reference
 
 
+_PENDING = object()     # marks a summary under construction
+
+_summarising = []       # for each component under construction, the
+                        # summaries under construction that it reads
+
+
+class ParameterSummary(object):
+    """This class summarises the values passed to the parameters
+        of a function, across all of its call sites.
+
+        For each parameter, `arguments` holds the resolved value of the
+        corresponding argument at every call site (`None` where a call
+        omits the argument).
+
+        Summaries are built with `get_parameter_summary()`, which caches
+        them in the function object. Building a summary resolves the
+        arguments of each call, and so reads the summaries of the callers,
+        which must be built before (or be under construction, for callers
+        within the same cycle of the call graph).
+    """
+
+    def __init__(self, function):
+        """Constructor for parameter summaries.
+
+        Args:
+            function (CodeFunction): The function to summarise.
+        """
+        self.function = function
+        self.calls = [call for call in function.references
+                      if isinstance(call, CodeFunctionCall)]
+        n = len(function.parameters)
+        self.arguments = [[] for _ in range(n)]
+        for call in self.calls:
+            for i in range(n):
+                value = None
+                if i < len(call.arguments):
+                    value = call.arguments[i]
+                    if isinstance(value, CodeExpression.TYPES):
+                        value = resolve_expression(value)
+                self.arguments[i].append(value)
+            caller = call.function
+            if caller is not None:
+                # this summary must go when the caller changes
+                if not getattr(caller, '_summary_dependents', None):
+                    caller._summary_dependents = set()
+                caller._summary_dependents.add(function)
+
+    def values(self, i):
+        """Return a tuple with the distinct constant values passed to the
+            *i*-th parameter, or `None` if some call site passes a value
+            that is not constant."""
+        values = []
+        seen = set()
+        for value in self.arguments[i]:
+            if not isinstance(value, CodeExpression.LITERALS):
+                return None
+            key = (type(value), value)  # e.g. 1 and True are different
+            if key not in seen:
+                seen.add(key)
+                values.append(value)
+        return tuple(values)
+
+    def value(self, i):
+        """Return the value of the *i*-th parameter, if known.
+
+            With a single call site, this is whatever that call passes.
+            Otherwise, it is the constant value that all calls agree on,
+            or `None`.
+        """
+        if len(self.arguments[i]) == 1:
+            return self.arguments[i][0]
+        values = self.values(i)
+        if values and len(values) == 1:
+            return values[0]
+        return None
+
+
+def get_parameter_summary(function):
+    """Return the `ParameterSummary` of a function.
+
+        Summaries depend on the summaries of the functions' callers (when
+        arguments are themselves parameters). On demand, the summaries
+        of a function and of its (transitive) callers are computed over
+        the call graph, one strongly connected component at a time, the
+        callers' components first. Within a component (a cycle of calls),
+        the values that depend on the summaries of the component itself
+        are unknown. Either way, the result does not depend on the order
+        in which summaries are requested.
+
+        Returns `None` for a function whose summary is being computed.
+    """
+    summary = getattr(function, '_summary', None)
+    if summary is _PENDING:
+        if _summarising:
+            _summarising[-1].add(function)
+        return None
+    if summary is None:
+        summary = _summarise(function)
+    return summary
+
+
+def parameter_values(var):
+    """Return a tuple with the possible constant values of a parameter,
+        across all calls of its function, or `None` if unknown."""
+    assert isinstance(var, CodeVariable)
+    function = var.scope
+    if not var.is_parameter:
+        return None
+    summary = get_parameter_summary(function)
+    if summary is None:
+        return None
+    return summary.values(function.parameters.index(var))
+
+
+def invalidate_summary(function):
+    """Discard the cached parameter summary of a function, along with the
+        summaries that were built from the calls within it."""
+    pending = [function]
+    while pending:
+        function = pending.pop()
+        if getattr(function, '_summary', None) is _PENDING:
+            continue
+        function._summary = None
+        pending.extend(getattr(function, '_summary_dependents', ()))
+        function._summary_dependents = set()
+
+
 def is_under_control_flow(codeobj, recursive = False):
     return get_control_depth(codeobj, recursive) > 0
 
@@ -265,6 +388,92 @@ def get_control_depth(codeobj, recursive = False):
     return depth
 
 
+def always_executed(codeobj, function=None):
+    """Whether a statement or expression is evaluated on every path
+        from the start of its function to a normal return.
+
+        Unlike `is_under_control_flow()`, this is based on control flow
+        (post-dominance), rather than syntactic nesting. Code that follows
+        an `if` with an early `return`, for instance, is not always executed.
+
+        Once the function's graph is built, the answer takes constant time.
+        Pass the enclosing `function`, if known, to skip looking it up.
+    """
+    cfg = _get_cfg(codeobj, function)
+    if cfg is None:
+        return False
+    block = cfg.block_of(codeobj)
+    if block is None:
+        return False
+    return cfg.post_dominators.dominates(block, cfg.ENTRY)
+
+
+def dominates(codeobj, other, function=None):
+    """Whether every path to `other` goes through `codeobj` first.
+        Both objects must belong to the same function.
+
+        NOTE: this works at basic block granularity; two objects within
+        the same block dominate each other.
+    """
+    cfg = _get_cfg(codeobj, function)
+    if cfg is None:
+        return False
+    a = cfg.block_of(codeobj)
+    b = cfg.block_of(other)
+    return a is not None and b is not None and cfg.dominators.dominates(a, b)
+
+
+def post_dominates(codeobj, other, function=None):
+    """Whether every path from `other` to a normal return goes through
+        `codeobj`. Both objects must belong to the same function.
+
+        NOTE: this works at basic block granularity; two objects within
+        the same block post-dominate each other.
+    """
+    cfg = _get_cfg(codeobj, function)
+    if cfg is None:
+        return False
+    a = cfg.block_of(codeobj)
+    b = cfg.block_of(other)
+    return (a is not None and b is not None
+            and cfg.post_dominators.dominates(a, b))
+
+
+def uses_of(definition, function=None):
+    """Return the references that may read the value written by
+        a definition (a declared variable or parameter, an assignment
+        or an increment/decrement operator, within a function body).
+
+        Chains are computed once per function; the lookup itself
+        takes constant time.
+    """
+    chains = _get_def_use(definition, function)
+    if chains is None:
+        return []
+    return chains.uses_of(definition)
+
+
+def defs_reaching(reference, function=None):
+    """Return the definitions (see `uses_of()`) whose value may be read
+        by a reference. A parameter is defined by its own declaration,
+        on entry, and so reaches its uses until it is overwritten.
+        Members and globals that are not written within the function
+        have no reaching definitions.
+    """
+    chains = _get_def_use(reference, function)
+    if chains is None:
+        return []
+    return chains.defs_reaching(reference)
+
+
+def dead_stores(function):
+    """Return the definitions of local variables, within a function,
+        whose value is never read."""
+    if not function.is_definition:
+        return []
+    return get_def_use(function).dead_stores()
+
+
 def is_under_loop(codeobj, recursive = False):
     while not codeobj is None:
         if (isinstance(codeobj, CodeBlock)
@@ -341,8 +550,92 @@ def _condition_obj(value, ctrl_flow_stmt):
         isinstance(value, CodeEntity), ctrl_flow_stmt.file,
         ctrl_flow_stmt.line, ctrl_flow_stmt.column, ctrl_flow_stmt.function)
 
+def _get_cfg(codeobj, function):
+    function = _get_definition(codeobj, function)
+    return None if function is None else get_cfg(function)
+
+def _get_def_use(codeobj, function):
+    function = _get_definition(codeobj, function)
+    return None if function is None else get_def_use(function)
+
+def _get_definition(codeobj, function):
+    if function is None:
+        if isinstance(codeobj, CodeFunction):
+            function = codeobj
+        else:
+            function = codeobj._lookup_parent(CodeFunction)
+    if function is None or not function.is_definition:
+        return None
+    return function
+
 def _get_function(codeobj):
     f = codeobj._lookup_parent(CodeFunction)
     if f is None or isinstance(f, CodeFunction):
         return f
     return None
+
+
+def _callers(function):
+    """Return the callers of a function that have no summary yet."""
+    return [call.function for call in function.references
+            if isinstance(call, CodeFunctionCall)
+            and call.function is not None
+            and getattr(call.function, '_summary', None) is None]
+
+def _summarise(function):
+    """Build the summaries of a function and its callers (that have none),
+        per strongly connected component of the call graph, callers first
+        (Tarjan's algorithm, iteratively), and return that of `function`."""
+    index = {function: 0}
+    low = {function: 0}
+    stack = [function]
+    on_stack = {function}
+    work = [(function, iter(_callers(function)))]
+    while work:
+        node, callers = work[-1]
+        caller = next(callers, None)
+        if caller is not None:
+            if caller not in index:
+                index[caller] = low[caller] = len(index)
+                stack.append(caller)
+                on_stack.add(caller)
+                work.append((caller, iter(_callers(caller))))
+            elif caller in on_stack:
+                low[node] = min(low[node], index[caller])
+            continue
+        work.pop()
+        if work:
+            parent = work[-1][0]
+            low[parent] = min(low[parent], low[node])
+        if low[node] == index[node]:
+            component = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.append(member)
+                if member is node:
+                    break
+            summary = _summarise_component(component)
+    return summary
+
+def _summarise_component(component):
+    members = set(component)
+    for function in component:
+        function._summary = _PENDING
+    reads = set()
+    _summarising.append(reads)
+    try:
+        summaries = [ParameterSummary(function) for function in component]
+    finally:
+        _summarising.pop()
+        for function in component:
+            function._summary = None
+    outside = reads - members
+    if outside:
+        # depends on summaries still under construction; do not cache
+        if _summarising:
+            _summarising[-1].update(outside)
+    else:
+        for function, summary in zip(component, summaries):
+            function._summary = summary
+    return summaries[-1]    # that of the root of the component
@@ -34,6 +34,7 @@ import pickle
 import importlib
 import logging
 import os
+import sys
 
 
 ###############################################################################
@@ -70,9 +71,62 @@ def parse_arguments(argv, source_runner):
                             help = "source workspace (default: user home)")
     parser_cpp.add_argument("-d", "--compile-db",
                             help = "compilation database directory")
-    parser_cpp.add_argument("files", nargs = "+", help = "files to parse")
+    parser_cpp.add_argument("--db-cache", action = "store_true",
+                            help = "keep a pickled index of the compilation database")
+    parser_cpp.add_argument("-j", "--jobs", type = int, default = 1,
+                            help = "parallel workers (0: one per CPU)")
+    parser_cpp.add_argument("--executor", default = "processes",
+                            choices = ["processes", "threads"],
+                            help = "kind of parallel workers (default: processes)")
+    parser_cpp.add_argument("--cache", metavar = "DIR",
+                            help = "cache parsed translation units in DIR")
+    parser_cpp.add_argument("--cache-check", default = "mtime",
+                            choices = ["mtime", "hash"],
+                            help = "how cached units are validated (default: mtime)")
+    parser_cpp.add_argument("--declarations-only", action = "store_true",
+                            help = "skip function bodies and initializers (symbol model)")
+    parser_cpp.add_argument("--headers-once", action = "store_true",
+                            help = "build workspace headers for the first unit only")
+    parser_cpp.add_argument("--depth-first", action = "store_true",
+                            help = "build the model depth-first (less pending work)")
+    parser_cpp.add_argument("--recycle-index", type = int, default = 0,
+                            metavar = "N",
+                            help = "use a new libclang index every N units")
+    parser_cpp.add_argument("--max-errors", type = int, metavar = "N",
+                            help = "skip units with more than N compile errors")
+    parser_cpp.add_argument("--no-tokens", action = "store_true",
+                            help = "with the ast format, do not count tokens")
+    parser_cpp.add_argument("--symbols-db", metavar = "FILE",
+                            help = "store the symbols of each unit in an SQLite database")
+    parser_cpp.add_argument("--all", action = "store_true",
+                            help = "parse every file in the compilation database")
+    parser_cpp.add_argument("--all-commands", action = "store_true",
+                            help = "with --all, parse files once per command")
+    parser_cpp.add_argument("--include", action = "append", metavar = "GLOB",
+                            help = "with --all, only parse matching files")
+    parser_cpp.add_argument("--exclude", action = "append", metavar = "GLOB",
+                            help = "with --all, skip matching files")
+    parser_cpp.add_argument("--shard", metavar = "I/N",
+                            help = "with --all, parse shard I (from 0) of N, "
+                                   "and write its fragments to the output file")
+    parser_cpp.add_argument("--shard-by", default = "hash",
+                            choices = ["hash", "cost"],
+                            help = "how --shard splits the files (default: hash)")
+    parser_cpp.add_argument("--simulate-shards", type = int, metavar = "N",
+                            help = "with --all, check that N merged shards "
+                                   "build the same model as a single run")
+    parser_cpp.add_argument("--ignore", action = "append", metavar = "GLOB",
+                            help = "build nothing from matching files (e.g. generated code)")
+    parser_cpp.add_argument("files", nargs = "*", help = "files to parse")
     parser_cpp.set_defaults(parser = parse_cpp, source_runner = source_runner)
 
+    parser_merge = subparsers.add_parser("merge",
+            help = "merge the shard files of a sharded cpp run")
+    parser_merge.add_argument("--strict", action = "store_true",
+                              help = "fail on entities defined in several shards")
+    parser_merge.add_argument("files", nargs = "+", help = "shard files")
+    parser_merge.set_defaults(parser = merge_shards)
+
     return parser.parse_args() if argv is None else parser.parse_args(argv)
 
 
@@ -84,18 +138,113 @@ def parse_cpp(args):
     else:
         parmod.CppAstParser.set_library_path()
     if args.compile_db:
-        parmod.CppAstParser.set_database(args.compile_db)
-    parser = parmod.CppAstParser(workspace = args.workspace)
-    if args.format == "ast":
-        output = []
-        for f in args.files:
-            output.append("# " + f)
-            output.append(parser.get_ast(os.path.abspath(f)))
-        return "\n".join(output)
+        parmod.CppAstParser.set_database(args.compile_db,
+                                         cache = args.db_cache)
+    if args.cache:
+        parmod.CppAstParser.set_cache(args.cache, check = args.cache_check)
+    symbols = None
+    if args.symbols_db:
+        symmod = importlib.import_module("..cpp.symbols", package = __name__)
+        symbols = symmod.SymbolDatabase(args.symbols_db)
+    parser = parmod.CppAstParser(workspace = args.workspace,
+                                 declarations_only = args.declarations_only,
+                                 headers_once = args.headers_once,
+                                 depth_first = args.depth_first,
+                                 recycle_index = args.recycle_index,
+                                 max_errors = args.max_errors,
+                                 exclude = args.ignore,
+                                 symbols = symbols,
+                                 logger = "bonsai")
+    if args.all:
+        if not args.compile_db:
+            raise ValueError("--all requires a compilation database")
+        if args.format == "ast":
+            raise ValueError("--all is not supported with the ast format")
+        if args.shard or args.simulate_shards:
+            return _run_shards(parmod, parser, args)
+        parser.parse_database(all_commands = args.all_commands,
+                              include = args.include, exclude = args.exclude,
+                              jobs = args.jobs or None,
+                              executor = args.executor)
+    elif not args.files:
+        raise ValueError("no files to parse")
+    elif args.format == "ast":
+        # streamed as each unit is visited, to the output file if given
+        stream = open(args.output, "w") if args.output else sys.stdout
+        try:
+            for f in args.files:
+                stream.write("# " + f + "\n")
+                if parser.get_ast(os.path.abspath(f), stream = stream,
+                                  tokens = not args.no_tokens) is None:
+                    raise ValueError("no compile commands for file " + f)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        return None
+    elif args.jobs != 1:
+        results = parser.parse_many(args.files, jobs = args.jobs or None,
+                                    executor = args.executor)
+        for f, result in zip(args.files, results):
+            if result is None:
+                raise ValueError("no compile commands for file " + f)
     else:
         for f in args.files:
             if parser.parse(os.path.abspath(f)) is None:
                 raise ValueError("no compile commands for file " + f)
+    if args.cache:
+        _log.debug(parmod.CppAstParser.cache.report())
+    _log.debug(parser.diagnostics.report())
+    if parser.symbols is not None:
+        _log.debug(parser.symbols.report())
+        parser.symbols.close()
+    _log.debug(parser.cursor_stats.report())
+    _log.debug("builders: at most %d pending", parser.peak_builders)
+    if parser.memory_samples:
+        _log.debug(parser.memory_report())
+    return parser
+
+
+def _run_shards(parmod, parser, args):
+    shards = importlib.import_module("..cpp.shards", package = __name__)
+    selection = dict(all_commands = args.all_commands,
+                     include = args.include, exclude = args.exclude)
+    jobs = args.jobs or None
+    if args.simulate_shards:
+        make_parser = lambda: parmod.CppAstParser(
+            workspace = args.workspace,
+            declarations_only = args.declarations_only,
+            headers_once = args.headers_once, depth_first = args.depth_first,
+            max_errors = args.max_errors, exclude = args.ignore,
+            logger = "bonsai")
+        merged, _, line = shards.simulate(make_parser, args.simulate_shards,
+                                          by = args.shard_by, jobs = jobs,
+                                          executor = args.executor,
+                                          **selection)
+        if line is not None:
+            raise RuntimeError("merged shards differ from a single run at: "
+                               + line)
+        _log.debug("%d shards (%s): same model as a single run",
+                   args.simulate_shards, args.shard_by)
+        return merged
+    index, count = shards.parse_shard(args.shard)
+    path = args.output or "shard-{}-of-{}.bonsai".format(index, count)
+    units = shards.run_shard(parser, path, index, count, by = args.shard_by,
+                             jobs = jobs, executor = args.executor,
+                             **selection)
+    _log.debug("shard %d of %d: %d units written to %s",
+               index, count, units, path)
+    return None
+
+
+def merge_shards(args):
+    parmod = importlib.import_module("..cpp.clang_parser", package = __name__)
+    shards = importlib.import_module("..cpp.shards", package = __name__)
+    parser = parmod.CppAstParser(logger = "bonsai")
+    try:
+        shards.merge(parser, args.files, strict = args.strict)
+    except parmod.MultipleDefinitionError as err:
+        raise RuntimeError(str(err))
+    _log.debug(parser.diagnostics.report())
     return parser
 
 
@@ -126,9 +275,9 @@ def main(argv = None, source_runner = False):
     try:
         _log.info("Executing selected parser.")
         parser = args.parser(args)
-        if args.format == "ast":
-            text = parser
-        elif args.format == "bonsai":
+        if parser is None:
+            return 0    # already written out (ast format, or a shard)
+        if args.format == "bonsai":
             text = bonsai_format(parser.global_scope)
         else:
             text = parser.global_scope.pretty_str()
@@ -0,0 +1,544 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+from __future__ import unicode_literals
+from builtins import object
+from builtins import range
+
+from .model import (
+    CodeBlock, CodeConditional, CodeControlFlow, CodeEntity, CodeFunction,
+    CodeJumpStatement, CodeLoop, CodeStatement, CodeSwitch, CodeTryBlock,
+    pretty_str
+)
+
+
+###############################################################################
+# Control Flow Graph
+###############################################################################
+
+class ControlFlowGraph(object):
+    """This class represents the control flow graph of a single function.
+
+        Basic blocks are identified by consecutive integers. The `ENTRY`
+        and `EXIT` blocks are always present and always empty. Every other
+        block holds a list of statements that execute in sequence.
+        Control flow statements (conditionals, loops, switches) are placed
+        at the end of the block that evaluates their condition.
+
+        Edges are kept in two adjacency lists (`successors` and
+        `predecessors`), indexed by block number.
+
+        Every program entity within the function (statements and the
+        expressions within them) can be mapped to its block in constant
+        time, with `block_of()`.
+    """
+
+    ENTRY = 0
+    EXIT = 1
+
+    def __init__(self, function):
+        """Constructor for control flow graphs.
+
+            The graph is built in a single pass over the function's body.
+
+        Args:
+            function (CodeFunction): The function to build a graph for.
+        """
+        assert isinstance(function, CodeFunction)
+        self.function = function
+        self.blocks = []
+        self.successors = []
+        self.predecessors = []
+        self._block_of = {}     # CodeEntity -> block
+        self._breaks = []       # stack of break targets
+        self._continues = []    # stack of continue targets
+        self._cases = {}        # case statement -> switch block
+        self._labels = {}       # labelled statement -> label name
+        self._targets = {}      # label name -> block
+        self._gotos = []        # [(block, label name)]
+        self._dominators = None
+        self._post_dominators = None
+        self._build()
+
+    @property
+    def dominators(self):
+        """The dominator tree of this graph (built on demand)."""
+        if self._dominators is None:
+            self._dominators = DominatorTree(self)
+        return self._dominators
+
+    @property
+    def post_dominators(self):
+        """The post-dominator tree of this graph (built on demand)."""
+        if self._post_dominators is None:
+            self._post_dominators = DominatorTree(self, post=True)
+        return self._post_dominators
+
+    def block_of(self, codeobj):
+        """Return the block where a program entity is evaluated,
+            or `None` if the entity is not part of this graph."""
+        return self._block_of.get(codeobj)
+
+    def reverse_postorder(self, backward=False):
+        """Return the blocks reachable from `ENTRY`, in reverse postorder.
+
+        Kwargs:
+            backward (bool): Walk the reversed graph, from `EXIT`,
+                instead. This is the natural order for backward problems.
+        """
+        if backward:
+            order = _postorder(self.EXIT, self.predecessors)
+        else:
+            order = _postorder(self.ENTRY, self.successors)
+        order.reverse()
+        return order
+
+    def _build(self):
+        self._new_block()   # ENTRY
+        self._new_block()   # EXIT
+        for name, statement in getattr(self.function, 'labels', {}).items():
+            self._labels[statement] = name
+        start = self._new_block()
+        self._edge(self.ENTRY, start)
+        self._block_of[self.function] = start
+        parameters = self.function.parameters
+        if isinstance(parameters, CodeEntity):
+            parameters = (parameters,)  # e.g. Python parameter lists
+        for codeobj in parameters or ():
+            self._map(codeobj, start)
+        end = self._visit_block(self.function.body, start)
+        self._edge(end, self.EXIT)
+        for block, label in self._gotos:
+            # unknown labels are assumed to leave the function
+            self._edge(block, self._targets.get(label, self.EXIT))
+        self._breaks = self._continues = self._gotos = None
+        self._cases = self._labels = self._targets = None
+
+    # ----- Graph Construction ------------------------------------------------
+
+    def _new_block(self):
+        self.blocks.append([])
+        self.successors.append([])
+        self.predecessors.append([])
+        return len(self.blocks) - 1
+
+    def _edge(self, source, target):
+        if source is None or target is None:
+            return
+        if target not in self.successors[source]:
+            self.successors[source].append(target)
+            self.predecessors[target].append(source)
+
+    def _map(self, codeobj, block):
+        """Map an entity and all its descendants to a block."""
+        if isinstance(codeobj, CodeEntity):
+            for descendant in codeobj.walk_preorder():
+                self._block_of[descendant] = block
+
+    def _append(self, codeobj, block):
+        """Add an entity to the end of a block.
+            Return the block, or a new (unreachable) block if `None`."""
+        if block is None:
+            block = self._new_block()
+        self.blocks[block].append(codeobj)
+        return block
+
+    def _visit_block(self, block, current):
+        self._block_of[block] = current
+        for codeobj in block.body:
+            current = self._visit(codeobj, current)
+        return current
+
+    def _visit(self, codeobj, current):
+        """Add a statement to the graph, starting at block `current`.
+            Return the block where control flow continues afterwards,
+            or `None` if the statement never completes normally.
+        """
+        if codeobj in self._cases or codeobj in self._labels:
+            block = self._new_block()
+            self._edge(current, block)
+            self._edge(self._cases.get(codeobj), block)
+            if codeobj in self._labels:
+                self._targets[self._labels[codeobj]] = block
+            current = block
+
+        if isinstance(codeobj, CodeJumpStatement):
+            return self._visit_jump(codeobj, current)
+        if isinstance(codeobj, CodeConditional):
+            return self._visit_conditional(codeobj, current)
+        if isinstance(codeobj, CodeLoop):
+            return self._visit_loop(codeobj, current)
+        if isinstance(codeobj, CodeSwitch):
+            return self._visit_switch(codeobj, current)
+        if isinstance(codeobj, CodeTryBlock):
+            return self._visit_try(codeobj, current)
+        if isinstance(codeobj, CodeBlock):
+            if current is None:
+                current = self._new_block()
+            return self._visit_block(codeobj, current)
+
+        current = self._append(codeobj, current)
+        self._map(codeobj, current)
+        return current
+
+    def _visit_header(self, codeobj, current):
+        """Add the condition of a control flow statement to a block."""
+        current = self._append(codeobj, current)
+        self._block_of[codeobj] = current
+        self._map(codeobj.condition, current)
+        return current
+
+    def _visit_jump(self, codeobj, current):
+        current = self._append(codeobj, current)
+        self._map(codeobj, current)
+        if codeobj.name == 'return':
+            self._edge(current, self.EXIT)
+        elif codeobj.name == 'break':
+            self._edge(current, (self._breaks or [self.EXIT])[-1])
+        elif codeobj.name == 'continue':
+            self._edge(current, (self._continues or [self.EXIT])[-1])
+        elif codeobj.name == 'goto':
+            self._gotos.append((current, codeobj.value))
+        else:
+            return current
+        return None
+
+    def _visit_conditional(self, codeobj, current):
+        header = self._visit_header(codeobj, current)
+        after = None
+        then_block = self._new_block()
+        self._edge(header, then_block)
+        end = self._visit_block(codeobj.body, then_block)
+        if end is not None:
+            after = self._new_block()
+            self._edge(end, after)
+        if codeobj.else_body.body:
+            else_block = self._new_block()
+            self._edge(header, else_block)
+            end = self._visit_block(codeobj.else_body, else_block)
+        else:
+            end = header
+        if end is not None:
+            if after is None:
+                after = self._new_block()
+            self._edge(end, after)
+        return after
+
+    def _visit_loop(self, codeobj, current):
+        if codeobj.declarations is not None:
+            current = self._visit(codeobj.declarations, current)
+        after = self._new_block()
+        if codeobj.name == 'do':
+            body = self._new_block()
+            self._edge(current, body)
+            header = self._new_block()
+            self._loop_body(codeobj, body, header, after)
+            self._visit_header(codeobj, header)
+            self._edge(header, body)
+        else:
+            header = self._new_block()
+            self._edge(current, header)
+            self._visit_header(codeobj, header)
+            body = self._new_block()
+            self._edge(header, body)
+            step = header
+            if codeobj.increment is not None:
+                step = self._new_block()
+                self._visit(codeobj.increment, step)
+                self._edge(step, header)
+            self._loop_body(codeobj, body, step, after)
+        if not codeobj.constant_condition:
+            # only loops like `while (true)` or `for (;;)` never exit here
+            self._edge(header, after)
+        return after if self.predecessors[after] else None
+
+    def _loop_body(self, codeobj, body, step, after):
+        self._breaks.append(after)
+        self._continues.append(step)
+        end = self._visit_block(codeobj.body, body)
+        self._edge(end, step)
+        self._continues.pop()
+        self._breaks.pop()
+
+    def _visit_switch(self, codeobj, current):
+        header = self._visit_header(codeobj, current)
+        after = self._new_block()
+        for _value, statement in codeobj.cases:
+            self._cases[statement] = header
+        if codeobj.default_case is not None:
+            self._cases[codeobj.default_case] = header
+        else:
+            self._edge(header, after)
+        self._breaks.append(after)
+        # the body is only reachable through its cases
+        end = self._visit_block(codeobj.body, None)
+        self._breaks.pop()
+        self._edge(end, after)
+        return after if self.predecessors[after] else None
+
+    def _visit_try(self, codeobj, current):
+        """NOTE: any block within the `try` body is assumed to be able
+            to jump to any of the `catch` blocks. Jumps out of the `try`
+            body (e.g. `return`) do not go through the `finally` body.
+        """
+        body = self._new_block()
+        self._edge(current, body)
+        self._block_of[codeobj] = body
+        end = self._visit_block(codeobj.body, body)
+        last = len(self.blocks)
+        after = self._new_block()
+        self._edge(end, after)
+        for catch in codeobj.catches:
+            handler = self._new_block()
+            self._block_of[catch] = handler
+            for block in range(body, last):
+                self._edge(block, handler)
+            if catch.declarations is not None:
+                handler = self._visit(catch.declarations, handler)
+            self._edge(self._visit_block(catch.body, handler), after)
+        if codeobj.finally_body.body:
+            finally_block = self._new_block()
+            self._edge(after, finally_block)
+            return self._visit_block(codeobj.finally_body, finally_block)
+        return after if self.predecessors[after] else None
+
+    # ----- Pretty Printing ---------------------------------------------------
+
+    def pretty_str(self, indent=0):
+        """Return a human-readable string representation of this graph.
+
+        Kwargs:
+            indent (int): The amount of spaces to use as indentation.
+        """
+        spaces = ' ' * indent
+        lines = []
+        for i in range(len(self.blocks)):
+            name = ('ENTRY' if i == self.ENTRY
+                    else 'EXIT' if i == self.EXIT else 'B' + str(i))
+            succ = ', '.join('B' + str(j) for j in self.successors[i])
+            lines.append('{}{} -> [{}]'.format(spaces, name, succ))
+            for codeobj in self.blocks[i]:
+                if isinstance(codeobj, CodeControlFlow):
+                    text = '{} ({})'.format(codeobj.name,
+                                            pretty_str(codeobj.condition))
+                else:
+                    text = pretty_str(codeobj)
+                lines.append(spaces + '  ' + text.strip().split('\n')[0])
+        return '\n'.join(lines)
+
+    def __len__(self):
+        """Return the number of blocks in the graph."""
+        return len(self.blocks)
+
+    def __repr__(self):
+        """Return a string representation of this object."""
+        return 'ControlFlowGraph({}, {} blocks)'.format(self.function.name,
+                                                       len(self.blocks))
+
+
+class DominatorTree(object):
+    """This class represents the dominator tree of a control flow graph.
+
+        A block *A* dominates a block *B* if every path from `ENTRY` to *B*
+        goes through *A*. When built with `post=True`, the tree is computed
+        over the reversed graph, rooted at `EXIT`, and represents
+        post-dominance instead (every path from *B* to `EXIT` goes
+        through *A*).
+
+        Immediate dominators are computed with the iterative algorithm of
+        Cooper, Harvey and Kennedy ("A Simple, Fast Dominance Algorithm").
+        The tree is then numbered with a depth-first traversal, so that
+        dominance queries are interval checks, answered in constant time.
+
+        Blocks that are not reachable from the root are not in the tree,
+        and neither dominate nor are dominated by any other block.
+        For post-dominance, blocks that never reach `EXIT` (e.g. an
+        infinite loop) get a virtual edge to it, from the last block of
+        each such region in depth-first order (e.g. the end of the loop
+        body), so that the code leading to them is still post-dominated
+        as usual.
+    """
+
+    def __init__(self, cfg, post=False):
+        """Constructor for dominator trees.
+
+        Args:
+            cfg (ControlFlowGraph): The graph to compute the tree for.
+
+        Kwargs:
+            post (bool): Whether to compute post-dominators instead.
+        """
+        if post:
+            self.root = cfg.EXIT
+            predecessors, successors = _exit_edges(cfg)
+        else:
+            self.root = cfg.ENTRY
+            successors = cfg.successors
+            predecessors = cfg.predecessors
+        n = len(cfg.blocks)
+        self.idom = [None] * n
+        self.children = [[] for _ in range(n)]
+        self._pre = [-1] * n
+        self._post = [-1] * n
+        self._compute(successors, predecessors)
+        self._number()
+
+    def immediate(self, block):
+        """Return the immediate dominator of a block, or `None`."""
+        if block == self.root:
+            return None
+        return self.idom[block]
+
+    def contains(self, block):
+        """Whether a block is part of this tree."""
+        return self._pre[block] >= 0
+
+    def dominates(self, a, b):
+        """Whether block `a` dominates block `b`."""
+        return (self._pre[a] >= 0 and self._pre[b] >= 0
+                and self._pre[a] <= self._pre[b]
+                and self._post[b] <= self._post[a])
+
+    def strictly_dominates(self, a, b):
+        """Whether block `a` dominates block `b`, and `a != b`."""
+        return a != b and self.dominates(a, b)
+
+    def _compute(self, successors, predecessors):
+        order = _postorder(self.root, successors)
+        index = [-1] * len(self.idom)
+        for i in range(len(order)):
+            index[order[i]] = i
+        idom = self.idom
+        idom[self.root] = self.root
+        changed = True
+        while changed:
+            changed = False
+            for b in reversed(order):
+                if b == self.root:
+                    continue
+                new_idom = None
+                for p in predecessors[b]:
+                    if idom[p] is None:
+                        continue    # unprocessed or unreachable
+                    if new_idom is None:
+                        new_idom = p
+                        continue
+                    # intersect, walking up the tree by postorder number
+                    while p != new_idom:
+                        while index[p] < index[new_idom]:
+                            p = idom[p]
+                        while index[new_idom] < index[p]:
+                            new_idom = idom[new_idom]
+                if idom[b] != new_idom:
+                    idom[b] = new_idom
+                    changed = True
+        for b in order:
+            if b != self.root:
+                self.children[idom[b]].append(b)
+
+    def _number(self):
+        counter = 0
+        stack = [(self.root, False)]
+        while stack:
+            block, done = stack.pop()
+            if done:
+                self._post[block] = counter
+            else:
+                self._pre[block] = counter
+                stack.append((block, True))
+                for child in self.children[block]:
+                    stack.append((child, False))
+            counter += 1
+
+
+###############################################################################
+# Interface Functions
+###############################################################################
+
+def get_cfg(function):
+    """Return the control flow graph of a function.
+
+        The graph is built on the first request and cached in the function
+        object. Call `invalidate_cfg()` if the function changes afterwards.
+    """
+    cfg = getattr(function, '_cfg', None)
+    if cfg is None:
+        cfg = ControlFlowGraph(function)
+        function._cfg = cfg
+    return cfg
+
+
+def invalidate_cfg(function):
+    """Discard the cached control flow graph of a function."""
+    function._cfg = None
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+def _exit_edges(cfg):
+    """Return the successors and predecessors of a graph, with virtual
+        edges to `EXIT` from blocks that would never reach it otherwise."""
+    successors = cfg.successors
+    predecessors = cfg.predecessors
+    reaches = [False] * len(cfg.blocks)
+    for block in _postorder(cfg.EXIT, predecessors):
+        reaches[block] = True
+    for block in _postorder(cfg.ENTRY, cfg.successors):
+        if reaches[block]:
+            continue
+        if successors is cfg.successors:
+            successors = [list(succs) for succs in successors]
+            predecessors = [list(preds) for preds in predecessors]
+        successors[block].append(cfg.EXIT)
+        predecessors[cfg.EXIT].append(block)
+        stack = [block]
+        reaches[block] = True
+        while stack:
+            for pred in predecessors[stack.pop()]:
+                if not reaches[pred]:
+                    reaches[pred] = True
+                    stack.append(pred)
+    return successors, predecessors
+
+
+def _postorder(root, successors):
+    """Return the blocks reachable from `root`, in depth-first postorder."""
+    order = []
+    visited = [False] * len(successors)
+    visited[root] = True
+    stack = [(root, iter(successors[root]))]
+    while stack:
+        block, it = stack[-1]
+        for succ in it:
+            if not visited[succ]:
+                visited[succ] = True
+                stack.append((succ, iter(successors[succ])))
+                break
+        else:
+            stack.pop()
+            order.append(block)
+    return order
@@ -0,0 +1,227 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+from __future__ import unicode_literals
+from builtins import object
+
+import hashlib
+import io
+import json
+import os
+import threading
+
+import clang.cindex as clang
+
+
+###############################################################################
+# Globals
+###############################################################################
+
+FORMAT = 2      # of cache entries; entries of other formats are missed
+
+
+###############################################################################
+# Translation Unit Cache
+###############################################################################
+
+class UnitCache(object):
+    """An on-disk cache of parsed translation units.
+
+        Units are saved in clang's serialized AST format, keyed by a hash
+        of the parse arguments and options (and of the libclang library
+        in use). Next to each AST, a small JSON file lists the unit's
+        dependencies: the main file and its whole include set, each with
+        a stamp. An entry is only used while all stamps still match.
+        The JSON file also keeps the diagnostics of the unit, as loaded
+        units do not have them.
+
+        Stamps are either the size and modification time of files
+        (`check='mtime'`), or a hash of their contents (`check='hash'`).
+    """
+
+    CHECKS = ('mtime', 'hash')
+
+    def __init__(self, directory, check='mtime'):
+        """Constructor for unit caches.
+
+        Args:
+            directory (str): Where to store the cache entries. It is
+                created if needed.
+
+        Kwargs:
+            check (str): How to validate dependencies ('mtime' or 'hash').
+        """
+        if check not in UnitCache.CHECKS:
+            raise ValueError('unknown cache check: ' + check)
+        self.directory = os.path.abspath(directory)
+        self.check = check
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def load(self, index, args, options=0):
+        """Return the cached unit for some parse arguments, along with
+            its diagnostics (as given to `store()`), or None.
+
+        Args:
+            index (clang.Index): The index to load the unit into.
+            args (list): The arguments the unit would be parsed with.
+
+        Kwargs:
+            options (int): The parse options the unit would be parsed with.
+        """
+        path = self._path(args, options)
+        entry = None
+        try:
+            with io.open(path + '.deps', encoding='utf-8') as handle:
+                data = json.load(handle)
+            if all(self._stamp(dep) == stamp for dep, stamp in data['deps']):
+                diagnostics = [tuple(d) for d in data['diagnostics']]
+                entry = (index.read(path + '.ast'), diagnostics)
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                clang.TranslationUnitLoadError):
+            entry = None    # missing or broken entry, as good as a miss
+        self._count('hits' if entry is not None else 'misses')
+        return entry
+
+    def store(self, unit, args, directory, options=0, diagnostics=()):
+        """Save a freshly parsed unit, under its parse arguments and
+            options. Relative file names are taken from the working
+            `directory`. The `diagnostics` of the unit, (severity, file,
+            line, column, message, category) tuples, are saved with it."""
+        path = self._path(args, options)
+        deps = [os.path.join(directory, unit.spelling)]
+        deps.extend(os.path.join(directory, inclusion.include.name)
+                    for inclusion in unit.get_includes())
+        temp = None
+        try:
+            data = {'deps': [(dep, self._stamp(dep)) for dep in set(deps)],
+                    'diagnostics': [list(d) for d in diagnostics]}
+            # complete files only, even with concurrent workers or crashes
+            temp = _temp_path(path + '.ast')
+            unit.save(temp)
+            replace_file(temp, path + '.ast')
+            temp = _temp_path(path + '.deps')
+            with io.open(temp, 'w', encoding='utf-8') as handle:
+                handle.write(json.dumps(data, ensure_ascii=False))
+            replace_file(temp, path + '.deps')
+        except (IOError, OSError, clang.TranslationUnitSaveError):
+            if temp is not None:
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass    # not written at all
+            self._count('errors')
+            return False
+        self._count('stores')
+        return True
+
+    def add_stats(self, stats):
+        """Add the counters of another cache (e.g. of a worker process)."""
+        with self._lock:
+            self.hits += stats[0]
+            self.misses += stats[1]
+            self.stores += stats[2]
+            self.errors += stats[3]
+
+    @property
+    def stats(self):
+        return (self.hits, self.misses, self.stores, self.errors)
+
+    def report(self):
+        """Return a one-line summary of the cache statistics."""
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return ('unit cache: {} hits, {} misses ({:.1f}% hit rate), '
+                '{} stored, {} errors').format(self.hits, self.misses, rate,
+                                               self.stores, self.errors)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _path(self, args, options):
+        key = hashlib.sha1()
+        key.update(_library_stamp().encode('utf-8'))
+        key.update('\0{}\0{}'.format(FORMAT, options).encode('utf-8'))
+        for arg in args:
+            key.update(b'\0')
+            key.update(arg.encode('utf-8'))
+        return os.path.join(self.directory, key.hexdigest())
+
+    def _stamp(self, file_path):
+        if self.check == 'hash':
+            digest = hashlib.sha1()
+            with open(file_path, 'rb') as handle:
+                for block in iter(lambda: handle.read(1 << 16), b''):
+                    digest.update(block)
+            return digest.hexdigest()
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime]
+
+
+###############################################################################
+# Files
+###############################################################################
+
+def replace_file(source, target):
+    """Rename a file to `target`, replacing any file already there."""
+    if hasattr(os, 'replace'):
+        os.replace(source, target)      # Python 3.3+
+        return
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)   # rename does not replace files on Windows
+    os.rename(source, target)
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+_library = None
+
+def _library_stamp():
+    """Identify the loaded libclang, as ASTs are not portable across
+        versions."""
+    global _library
+    if _library is None:
+        name = getattr(clang.conf.lib, '_name', None) or ''
+        try:
+            stat = os.stat(name)
+            _library = '{}:{}:{}'.format(name, stat.st_size, stat.st_mtime)
+        except (OSError, TypeError):
+            _library = name
+    return _library
+
+
+def _temp_path(path):
+    """Return a temporary name for a file, unique to this process and
+        thread, to be renamed into place when complete."""
+    return '{}.{}.{}'.format(path, os.getpid(),
+                             threading.current_thread().ident)
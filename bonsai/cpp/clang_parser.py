@@ -27,15 +27,30 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import next
 from builtins import object
+from builtins import range
 
 from collections import deque
 from ctypes import ArgumentError
+from functools import partial
+import hashlib
+import io
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import pickle
+import threading
 
 import clang.cindex as clang
 
-from ..parser import AnalysisData, MultipleDefinitionError, CodeAstParser
+from ..analysis import invalidate_summary
+from ..model import SomeValue
+from ..parser import (AnalysisData, MultipleDefinitionError, CodeAstParser,
+                      Diagnostic, Diagnostics, PathFilter)
+from .cache import UnitCache
+from .compdb import CompilationDatabase
+from .cursors import CursorFiles, CursorRecords, CursorStats
 from .model import *
+from .tokens import forget_tokens, token_count, token_spellings
 
 
 ###############################################################################
@@ -44,6 +59,8 @@ from .model import *
 
 CK = clang.CursorKind
 
+_TEMPLATE_MEMO_SIZE = 4096  # memoized `_parse_templates` results
+
 
 ###############################################################################
 # Notes to Self
@@ -79,14 +96,44 @@ class CppEntityBuilder(object):
         except ArgumentError as e:
             pass
 
+    # kind -> ((order, handler), ...), see `_dispatch_table`
+    _HANDLERS = {}
+    _FALLBACK = ()
+
     def build(self, data):
         """Build an object for the current cursor and
             corresponding builders for the cursor's children.
             Return None if an object cannot be built.
             Return (object, [builders]) otherwise.
         """
+        return self._dispatch(data)
+
+    def _dispatch(self, data, after=-1):
+        """Try the handlers of the cursor's kind, in order, until one of
+            them builds an object. A handler may also replace the cursor
+            (e.g. with a child) and return None; the cursor then goes on
+            to those of the following handlers that accept its kind."""
+        cursor = self.cursor
+        for order, handler in self._HANDLERS.get(cursor.kind, self._FALLBACK):
+            if order <= after:
+                continue
+            result = handler(self, data)
+            if result:
+                return result
+            if self.cursor is not cursor:
+                return self._dispatch(data, after=order)
         return None
 
+    @staticmethod
+    def _dispatch_table(*handlers):
+        """Map each kind to its handlers, given (handler, kinds) pairs in
+            the order they are to be tried."""
+        table = {}
+        for order, (handler, kinds) in enumerate(handlers):
+            for kind in kinds:
+                table[kind] = table.get(kind, ()) + ((order, handler),)
+        return table
+
     # Let's add some methods here, just to avoid code duplication.
 
     def _build_variable(self, data):
@@ -121,17 +168,7 @@ class CppExpressionBuilder(CppEntityBuilder):
         self.result = cursor.type.spelling or '[type]'
         self.parenthesis = False
 
-    def build(self, data):
-        return (self._pre_process_strings()
-                or self._build_literal()
-                or self._build_reference(data)
-                or self._build_operator()
-                or self._build_function_call(data)
-                or self._build_default_argument()
-                or self._build_other(data)
-                or self._build_unexposed(data))
-
-    def _pre_process_strings(self):
+    def _pre_process_strings(self, data):
         if self.cursor.kind == CK.CALL_EXPR and self.name == "basic_string":
             cursor = next(self.cursor.get_children(), None)
             if not cursor:
@@ -144,12 +181,16 @@ class CppExpressionBuilder(CppEntityBuilder):
                     self.name = cursor.spelling
         return None
 
-    def _build_literal(self):
-        token = next(self.cursor.get_tokens(), None)
+    _LITERALS = (CK.INTEGER_LITERAL, CK.FLOATING_LITERAL,
+                 CK.CHARACTER_LITERAL, CK.CXX_BOOL_LITERAL_EXPR)
+
+    def _build_literal(self, data):
+        if self.cursor.kind in CppExpressionBuilder._LITERALS:
+            tokens = token_spellings(self.cursor)
+            token = tokens[0] if tokens else None
 
         if self.cursor.kind == CK.INTEGER_LITERAL:
             if token:
-                token = token.spelling
                 while token.endswith(("U", "u", "L", "l")):
                     token = token[:-1]
                 try:
@@ -160,16 +201,16 @@ class CppExpressionBuilder(CppEntityBuilder):
 
         if self.cursor.kind == CK.FLOATING_LITERAL:
             if token:
-                if token.spelling[-1].isalpha():
-                    return float(token.spelling[:-1]), ()
-                return float(token.spelling), ()
+                if token[-1].isalpha():
+                    return float(token[:-1]), ()
+                return float(token), ()
             return SomeCpp.FLOATING, ()
 
         if self.cursor.kind == CK.CHARACTER_LITERAL:
-            return (token.spelling, ()) if token else (SomeCpp.CHARACTER, ())
+            return (token, ()) if token else (SomeCpp.CHARACTER, ())
 
         if self.cursor.kind == CK.CXX_BOOL_LITERAL_EXPR:
-            return (token.spelling == 'true', ()) if token \
+            return (token == 'true', ()) if token \
                                                   else (SomeCpp.BOOL, ())
         if self.cursor.kind == CK.STRING_LITERAL:
             if self.name.startswith('"'):
@@ -213,7 +254,7 @@ class CppExpressionBuilder(CppEntityBuilder):
 
         return None
 
-    def _build_operator(self):
+    def _build_operator(self, data):
         # TODO conditional operator
         name = None
         if self.cursor.kind == CK.UNARY_OPERATOR:
@@ -254,7 +295,7 @@ class CppExpressionBuilder(CppEntityBuilder):
                 cppobj.column = self.column
                 cppobj.parenthesis = self.parenthesis
     # ----- this is still tentative -------------------------------------------
-                tokens = [t.spelling for t in self.cursor.get_tokens()]
+                tokens = token_spellings(self.cursor)
                 try:
                     cppobj.full_name = "".join(tokens[:tokens.index("(")])
                 except ValueError as e:
@@ -326,7 +367,7 @@ class CppExpressionBuilder(CppEntityBuilder):
 
         return None
 
-    def _build_default_argument(self):
+    def _build_default_argument(self, data):
         if (isinstance(self.parent, CppFunctionCall)
                 and self.cursor.kind == CK.UNEXPOSED_EXPR
                 and not next(self.cursor.get_children(), None)):
@@ -373,15 +414,15 @@ class CppExpressionBuilder(CppEntityBuilder):
         return None
 
     def _parse_unary_operator(self):
-        tokens = list(self.cursor.get_tokens())
+        tokens = token_spellings(self.cursor)
         if tokens:
-            token = tokens[0].spelling
+            token = tokens[0]
 
             if token in CppOperator._UNARY_TOKENS:
                 return token
 
             # The last token seems to be what ends the expression, e.g. ';'
-            token = tokens[-2].spelling
+            token = tokens[-2]
             if token in CppOperator._UNARY_TOKENS:
                 return '_' + token if token in ('++', '--') else token
 
@@ -394,13 +435,26 @@ class CppExpressionBuilder(CppEntityBuilder):
         # All operators seem to be infix; get the last token of the first child
         child = next(self.cursor.get_children(), None)
         if child:
-            tokens = list(child.get_tokens())
+            tokens = token_spellings(child)
             if tokens:
-                token = tokens[-1].spelling
+                token = tokens[-1]
                 if token in CppOperator._BINARY_TOKENS:
                     return token
 
+    _templates = {}     # (name, text) -> templates, shared by all builders
+
     def _parse_templates(self, name, text):
+        key = (name, text)
+        templates = CppExpressionBuilder._templates.get(key)
+        if templates is None:
+            if len(CppExpressionBuilder._templates) >= _TEMPLATE_MEMO_SIZE:
+                CppExpressionBuilder._templates.clear()
+            templates = self._scan_templates(name, text)
+            CppExpressionBuilder._templates[key] = templates
+        return templates
+
+    @staticmethod
+    def _scan_templates(name, text):
         templates = []
         start = text.find("<")
         if (start >= 0 and not "<" in name and not ">" in name
@@ -419,27 +473,32 @@ class CppExpressionBuilder(CppEntityBuilder):
             templates.append(text[start+1:i-1])
         return tuple(templates)
 
+    _HANDLERS = CppEntityBuilder._dispatch_table(
+        (_pre_process_strings, (CK.CALL_EXPR,)),
+        (_build_literal, _LITERALS + (CK.STRING_LITERAL,)),
+        (_build_reference, (CK.DECL_REF_EXPR, CK.MEMBER_REF,
+                            CK.MEMBER_REF_EXPR, CK.CXX_THIS_EXPR)),
+        (_build_operator, (CK.UNARY_OPERATOR, CK.BINARY_OPERATOR,
+                           CK.COMPOUND_ASSIGNMENT_OPERATOR)),
+        (_build_function_call, (CK.CXX_NEW_EXPR, CK.CALL_EXPR,
+                                CK.CXX_DELETE_EXPR)),
+        (_build_default_argument, (CK.UNEXPOSED_EXPR,)),
+        (_build_other, (CK.PAREN_EXPR, CK.CSTYLE_CAST_EXPR)),
+        (_build_unexposed, (CK.CXX_FUNCTIONAL_CAST_EXPR, CK.UNEXPOSED_EXPR))
+    )
+
 
 class CppStatementBuilder(CppEntityBuilder):
     jump_mapping = {
         CK.BREAK_STMT: 'break',
         CK.CONTINUE_STMT: 'continue',
-        CK.RETURN_STMT: 'return'
+        CK.RETURN_STMT: 'return',
+        CK.GOTO_STMT: 'goto'
     }
 
     def __init__(self, cursor, scope, parent, insert=None):
         CppEntityBuilder.__init__(self, cursor, scope, parent, insert=insert)
 
-    def build(self, data):
-        return (self._build_declarations(data)
-                or self._build_expression(data)
-                or self._build_control_flow()
-                or self._build_jump_statement()
-                or self._build_block()
-                or self._build_try_block(data)
-                or self._build_unexposed(data)
-                or self._build_label_statement(data))
-
     def _build_expression(self, data):
         builder = CppExpressionBuilder(self.cursor, self.scope, self.parent)
         result = builder.build(data)
@@ -482,8 +541,20 @@ class CppStatementBuilder(CppEntityBuilder):
 
         return None
 
-    def _build_control_flow(self):
-        if not next(self.cursor.get_tokens(), None):
+    _KEYWORDS = {
+        CK.WHILE_STMT: 'while',
+        CK.FOR_STMT: 'for',
+        CK.DO_STMT: 'do',
+        CK.IF_STMT: 'if',
+        CK.SWITCH_STMT: 'switch'
+    }
+
+    def _build_control_flow(self, data):
+        keyword = CppStatementBuilder._KEYWORDS.get(self.cursor.kind)
+        if keyword is None:
+            return None
+        tokens = token_spellings(self.cursor)
+        if not tokens or tokens[0] != keyword:
             # This is to try to avoid ROS_INFO and similar things.
             return None
 
@@ -500,7 +571,7 @@ class CppStatementBuilder(CppEntityBuilder):
 
         return None
 
-    def _build_jump_statement(self):
+    def _build_jump_statement(self, data):
         name = self.jump_mapping.get(self.cursor.kind, None)
         if name is None:
             return None
@@ -518,9 +589,14 @@ class CppStatementBuilder(CppEntityBuilder):
                 builders = [CppExpressionBuilder(expression,
                                                  self.scope, cppobj)]
 
+        elif self.cursor.kind == CK.GOTO_STMT:
+            label = next(self.cursor.get_children(), None)
+            if label:
+                cppobj._add(label.spelling)
+
         return cppobj, builders
 
-    def _build_block(self):
+    def _build_block(self, data):
         if self.cursor.kind == CK.NULL_STMT:
             return None
 
@@ -631,7 +707,7 @@ class CppStatementBuilder(CppEntityBuilder):
 
         if len(children) == 1:
             # ----- just body -------------------------------------
-            cppobj.condition = True
+            cppobj._set_condition(True)
 
         elif len(children) == 2:
             # ----- condition + body ------------------------------
@@ -764,7 +840,19 @@ class CppStatementBuilder(CppEntityBuilder):
             self.cursor = original
             return result
 
-        # TODO if self.cursor.kind == CK.LABEL_STMT:
+        if self.cursor.kind == CK.LABEL_STMT:
+            function = self._lookup_parent(CppFunction)
+            self.cursor = next(self.cursor.get_children())
+            result = self.build(data)
+            if not result:
+                # e.g. "end: ;" - keep an empty statement as the target
+                result = (CppBlock(self.scope, self.parent, explicit=False),
+                          ())
+            if function is not None:
+                function._add_label(original.spelling, result[0])
+            self.cursor = original
+            return result
+
         return None
 
     def _build_unexposed(self, data):
@@ -775,22 +863,47 @@ class CppStatementBuilder(CppEntityBuilder):
                 return self.build(data)
         return None
 
+    # any kind of expression is also an expression statement
+    _HANDLERS = CppEntityBuilder._dispatch_table(
+        (_build_declarations, (CK.DECL_STMT,)),
+        (_build_expression, tuple(CppExpressionBuilder._HANDLERS)),
+        (_build_control_flow, tuple(_KEYWORDS)),
+        (_build_jump_statement, tuple(jump_mapping)),
+        (_build_block, (CK.NULL_STMT, CK.COMPOUND_STMT)),
+        (_build_try_block, (CK.CXX_CATCH_STMT, CK.CXX_TRY_STMT)),
+        (_build_unexposed, (CK.UNEXPOSED_STMT,)),
+        (_build_label_statement, (CK.CASE_STMT, CK.DEFAULT_STMT,
+                                  CK.LABEL_STMT))
+    )
+
 
 class CppTopLevelBuilder(CppEntityBuilder):
     _FUNCTIONS = (CK.FUNCTION_DECL, CK.FUNCTION_TEMPLATE, CK.CXX_METHOD,
                   CK.CONSTRUCTOR, CK.DESTRUCTOR)
 
-    def __init__(self, cursor, scope, parent, insert=None, workspace=''):
+    def __init__(self, cursor, scope, parent, insert=None, workspace='',
+                 bodies=True):
         CppEntityBuilder.__init__(self, cursor, scope, parent, insert=insert)
         self.name = cursor.spelling
         self.workspace = workspace
+        self.bodies = bodies    # False: no function bodies or initializers
 
     def build(self, data):
-        return (self._build_variable(data)
-                or self._build_function(data)
-                or self._build_class(data)
-                or self._build_namespace()
-                or self._build_enum())
+        result = self._dispatch(data)
+        if result:
+            cppobj = result[0]
+            cppobj.file = self.file
+            cppobj.line = self.line
+            cppobj.column = self.column
+        return result
+
+    def _build_declaration(self, data):
+        result = self._build_variable(data)
+        if (result and not self.bodies
+                and self.cursor.kind != CK.ENUM_CONSTANT_DECL):
+            # enumerator values are part of the declaration, not bodies
+            return result[0], ()
+        return result
 
     def _build_function(self, data):
         if self.cursor.kind not in CppTopLevelBuilder._FUNCTIONS:
@@ -818,12 +931,21 @@ class CppTopLevelBuilder(CppEntityBuilder):
                     ctype = cursor.type.get_canonical().spelling or "[type]"
                     var = CppVariable(cppobj, cppobj, id, name, result,
                                       ctype=ctype)
+                    location = cursor.location
+                    if location.file:
+                        var.file = self.file
+                        var.line = location.line
+                        var.column = location.column
                     data.register(var)
                     cppobj.parameters.append(var)
 
                 elif cursor.kind == CK.TEMPLATE_TYPE_PARAMETER:
                     cppobj.template_parameters += 1
 
+                elif cursor.kind == CK.MEMBER_REF and not self.bodies:
+                    declaration = False
+                    next(children, None)    # skip the initializer, too
+
                 elif cursor.kind == CK.MEMBER_REF:
                     # This is for constructors, we need the sibling
                     declaration = False
@@ -842,12 +964,16 @@ class CppTopLevelBuilder(CppEntityBuilder):
 
                 elif cursor.kind == CK.COMPOUND_STMT:
                     declaration = False
-                    builders.extend(
-                            CppStatementBuilder(c, cppobj, cppobj)
-                            for c in cursor.get_children()
-                    )
+                    if self.bodies:
+                        builders.extend(
+                                CppStatementBuilder(c, cppobj, cppobj)
+                                for c in cursor.get_children()
+                        )
 
                 cursor = next(children, None)
+            if not self.bodies:
+                # NOTE: skipped bodies leave no COMPOUND_STMT behind
+                declaration = not _has_skipped_body(self.cursor)
             cppobj._definition = cppobj if not declaration else None
             try:
                 data.register(cppobj, declaration=declaration)
@@ -869,7 +995,7 @@ class CppTopLevelBuilder(CppEntityBuilder):
                     cppobj.superclasses.append(cursor.spelling)
                 else:
                     declaration = False
-                    builders.append(CppTopLevelBuilder(cursor, cppobj, cppobj))
+                    builders.append(self._child(cursor, cppobj))
             cppobj._definition = cppobj if not declaration else None
             try:
                 data.register(cppobj, declaration=declaration)
@@ -878,38 +1004,110 @@ class CppTopLevelBuilder(CppEntityBuilder):
             return (cppobj, builders)
         return None
 
-    def _build_namespace(self):
+    def _build_namespace(self, data):
         if self.cursor.kind == CK.NAMESPACE:
             cppobj = CppNamespace(self.scope, self.parent, self.name)
             builders = [
-                CppTopLevelBuilder(c, cppobj, cppobj)
+                self._child(c, cppobj)
                 for c in self.cursor.get_children()
             ]
             return cppobj, builders
 
         return None
 
-    def _build_enum(self):
+    def _build_enum(self, data):
         if self.cursor.kind == CK.ENUM_DECL:
             name = self.cursor.spelling
             cppobj = CppEnum(self.scope, self.parent, name)
             builders = [
-                CppTopLevelBuilder(c, cppobj, cppobj)
+                self._child(c, cppobj)
                 for c in self.cursor.get_children()
             ]
             return cppobj, builders
         return None
 
+    def _child(self, cursor, cppobj):
+        return CppTopLevelBuilder(cursor, cppobj, cppobj, bodies=self.bodies)
+
+    _HANDLERS = CppEntityBuilder._dispatch_table(
+        (_build_declaration, (CK.VAR_DECL, CK.FIELD_DECL,
+                              CK.ENUM_CONSTANT_DECL)),
+        (_build_function, _FUNCTIONS),
+        (_build_class, _CLASSES),
+        (_build_namespace, (CK.NAMESPACE,)),
+        (_build_enum, (CK.ENUM_DECL,))
+    )
+
 
 ###############################################################################
 # AST Parsing
 ###############################################################################
 
+class ModelFragment(object):
+    """The model of a single translation unit, built on its own.
+
+        Its entities are not linked to those of other units. Instead, the
+        registrations and references (by USR) made while building it are
+        kept, in order, as `events`, to be replayed by
+        `CppAstParser.link()` against the data of the whole program.
+        Fragments can thus be built in other processes (or machines), and
+        cached individually, as bytes (see `dumps()` and `loads()`).
+    """
+
+    def __init__(self, unit, scope, events, file_entities,
+                 cursor_counts=(0, 0), peak_builders=0, diagnostics=None,
+                 headers=None):
+        """Constructor for model fragments.
+
+        Args:
+            unit (str): The main file of the translation unit.
+            scope (CppGlobalScope): The global scope of the unit.
+            events (list): `(codeobj, declaration)` registrations and
+                `(ref, refd_id)` references, as recorded by `_UnitData`.
+            file_entities (dict): File -> top-level objects built from it.
+
+        Kwargs:
+            cursor_counts (tuple): The `CursorStats` counts of the unit.
+            peak_builders (int): The most builders pending at once.
+            diagnostics (Diagnostics): The diagnostics of the unit.
+            headers (dict): With `headers_once`, header -> the key that
+                tells whether an earlier unit built it (it is built by
+                every fragment, and kept or not when linking).
+        """
+        self.unit = unit
+        self.scope = scope
+        self.events = events
+        self.file_entities = file_entities
+        self.cursor_counts = cursor_counts
+        self.peak_builders = peak_builders
+        self.diagnostics = diagnostics
+        self.headers = headers
+
+    def dumps(self):
+        """Return the fragment pickled, as bytes."""
+        return _dumps(self)
+
+    @staticmethod
+    def loads(data):
+        """Return the fragment pickled in some bytes."""
+        return _loads(data)
+
+
 class CppAstParser(CodeAstParser):
     lib_path = None
     lib_file = None
     includes = "/usr/lib/llvm-3.8/lib/clang/3.8.0/include"
     database = None
+    cache = None
+
+    # parse options, to combine in `parse_options`
+    PARSE_INCOMPLETE = clang.TranslationUnit.PARSE_INCOMPLETE
+    PARSE_PRECOMPILED_PREAMBLE = \
+        clang.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE
+    PARSE_CACHE_COMPLETION_RESULTS = \
+        clang.TranslationUnit.PARSE_CACHE_COMPLETION_RESULTS
+    PARSE_SKIP_FUNCTION_BODIES = \
+        clang.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
 
     # system required / user optional
     @staticmethod
@@ -924,99 +1122,713 @@ class CppAstParser(CodeAstParser):
 
     # optional
     @staticmethod
-    def set_database(db_path):
-        if not CppAstParser.lib_path:
-            CppAstParser.set_library_path()
-        CppAstParser.database = clang.CompilationDatabase.fromDirectory(db_path)
-        CppAstParser.database.db_path = db_path
+    def set_database(db_path, cache=False):
+        CppAstParser.database = CompilationDatabase.from_directory(db_path,
+                                                                   cache=cache)
+
+    # optional
+    @staticmethod
+    def set_cache(cache_dir, check='mtime'):
+        CppAstParser.cache = UnitCache(cache_dir, check=check)
 
     # optional
     @staticmethod
     def set_standard_includes(std_includes):
         CppAstParser.includes = std_includes
 
-    def __init__(self, workspace = "", user_includes = None, logger=None):
+    def __init__(self, workspace = "", user_includes = None, logger=None,
+                 parse_options=0, declarations_only=False, headers_once=False,
+                 depth_first=False, recycle_index=0, max_errors=None,
+                 include=None, exclude=None, symbols=None):
         CodeAstParser.__init__(self, workspace, logger)
     # public:
         self.workspace      = os.path.abspath(workspace) if workspace else ""
+        # files whose declarations are built: in the workspace, matching
+        # `include` (if given) and not matching `exclude` (glob patterns)
+        self.path_filter    = PathFilter((self.workspace,), include, exclude)
         self.global_scope   = CppGlobalScope()
         self.data           = AnalysisData()
         self.user_includes  = [] if user_includes is None else user_includes
+        self.parse_options  = parse_options
+        # only declarations: a symbol model, without bodies or initializers
+        self.declarations_only = declarations_only
+        # build workspace headers once, for the first unit that includes them
+        self.headers_once   = headers_once
+        # build depth-first, rather than breadth-first (less pending work)
+        self.depth_first    = depth_first
+        # the largest number of pending builders, over all units
+        self.peak_builders  = 0
+        # a new Index after this many units (0: keep the same one)
+        self.recycle_index  = recycle_index
+        # resident memory (bytes) after each unit of a batch
+        self.memory_samples = []
+        # units with more errors than this are not built (None: no limit)
+        self.max_errors     = max_errors
+        # a SymbolDatabase, updated with the files of each unit built
+        self.symbols        = symbols
+        # attributes read from libclang by the builders, and reads saved
+        self.cursor_stats   = CursorStats()
     # private:
         self._index         = None
+        self._index_units   = 0     # units parsed with the current index
+        self._main_file     = None  # of the last unit parsed
         self._db            = CppAstParser.database
+        self._cache         = CppAstParser.cache
+        self._units         = {}    # file -> live TranslationUnit (reparse)
+        self._file_entities = {}    # file -> [top-level objects built from it]
+        self._headers       = set() # (header, digest, macro args) ingested
+        self._unit_headers  = None  # header -> key, decided when linking
+        self._digests       = {}    # header -> (stat stamp, content digest)
 
-    @CodeAstParser.with_logger
     def parse(self, file_path):
+        # with a precompiled preamble, the unit is kept for reparse()
+        keep = bool(self.parse_options
+                    & CppAstParser.PARSE_PRECOMPILED_PREAMBLE)
+        if self._parse_unit(os.path.abspath(file_path), keep=keep) is None:
+            return None
+        self.global_scope._afterpass()
+        return self.global_scope
+
+    def reparse(self, file_path, unsaved_files=None):
+        """Parse a file again (e.g. after an edit) and replace, in the
+            program model, the entities built from that file.
+
+            The translation unit is kept alive between calls (and from
+            `parse()`, with the `PARSE_PRECOMPILED_PREAMBLE` option), and
+            reparsed by libclang, which is much faster with that option.
+            Entities from other files (including headers) are kept;
+            references to and from the replaced entities are relinked by
+            id. A file that was not built before is built as by `parse()`,
+            headers included.
+
+        Args:
+            file_path (str): The file to parse (with its first compile
+                command, if there is a compilation database).
+
+        Kwargs:
+            unsaved_files (list): (file name, contents) pairs, for files
+                whose contents differ from what is on disk.
+
+        Returns:
+            CppGlobalScope: The global scope, or None if the file has
+                no compile commands.
+        """
         file_path = os.path.abspath(file_path)
-        if self._db is None:
-            return self._parse_without_db(file_path)
-        return self._parse_from_db(file_path)
+        command = self._unit_command(file_path)
+        if command is None:
+            return None
+        path = os.path.normpath(file_path)
+        built = path in self._file_entities
+        unit = self._units.get(file_path)
+        if unit is None:
+            if self._index is None:
+                self._index = clang.Index.create()
+            unit = self._index.parse(None, self._args(command),
+                                     unsaved_files=unsaved_files,
+                                     options=self._options())
+            self._units[file_path] = unit
+        else:
+            unit.reparse(unsaved_files=unsaved_files)
+            forget_tokens(unit)
+        self.diagnostics.clear(path)
+        self._collect_diagnostics(_unit_diagnostics(unit), path)
+
+        # ----- model update --------------------------------------------------
+        old = self._file_entities.pop(path, ())
+        removed = set()
+        for codeobj in old:
+            _detach(codeobj)
+            removed.update(id(obj) for obj in codeobj.walk_preorder())
+        for codeobj in old:
+            self._unlink(codeobj, removed)
+        # the headers of a file built before are already in the model
+        only = path if built else None
+        self._ast_analysis(unit.cursor, command[0], only=only)
+        ids = set()
+        for codeobj in list(old) + self._file_entities.get(path, []):
+            ids.update(getattr(obj, 'id', None)
+                       for obj in codeobj.walk_preorder())
+        ids.discard(None)
+        self._relink(ids)
+        self.global_scope._afterpass()
+        return self.global_scope
 
-    def get_ast(self, file_path):
+    def parse_many(self, file_paths, jobs=None, executor='processes'):
+        """Parse several files into this parser's program model, with
+            a pool of workers.
+
+            Each worker parses and builds whole translation units on its
+            own, recording (rather than linking) entity registrations and
+            references. The units are then merged by the calling thread,
+            in the given order, replaying the recorded calls against
+            `self.data`. The resulting model is the same as parsing the
+            files one by one.
+
+            Worker processes send their units back pickled. Worker threads
+            avoid that cost, and still run in parallel while libclang
+            parses (ctypes releases the GIL), but the model is built under
+            the GIL.
+
+        Args:
+            file_paths (list): The files to parse.
+
+        Kwargs:
+            jobs (int): The number of workers (default: one per CPU).
+                With a single job, files are parsed by the calling thread.
+            executor (str): Either 'processes' or 'threads'.
+
+        Returns:
+            list: For each file, what `parse()` would return; that is,
+                the global scope, or None if the file has no compile
+                commands.
+        """
+        file_paths = [os.path.abspath(f) for f in file_paths]
+        return self._parse_all(file_paths, jobs, executor)
+
+    def parse_database(self, all_commands=False, include=None, exclude=None,
+                       jobs=1, executor='processes'):
+        """Parse the files of the whole compilation database.
+
+            The database is read once. Identical (file, arguments) pairs are
+            only parsed once, and so are files with several commands,
+            unless `all_commands` is set.
+
+        Kwargs:
+            all_commands (bool): Parse a file once for each of its
+                (distinct) compile commands, instead of the first only.
+            include (list): If given, only parse files whose absolute
+                path matches one of these glob patterns.
+            exclude (list): Skip files whose absolute path matches one
+                of these glob patterns.
+            jobs (int): The number of workers, as in `parse_many()`.
+            executor (str): The kind of workers, as in `parse_many()`.
+
+        Returns:
+            CppGlobalScope: The global scope of the program model.
+        """
+        commands = self.database_commands(all_commands=all_commands,
+                                          include=include, exclude=exclude)
+        self._parse_all(commands, jobs, executor)
+        return self.global_scope
+
+    @property
+    def database_root(self):
+        """The directory of the compilation database, or None."""
+        return getattr(self._db, 'db_path', None)
+
+    def database_commands(self, all_commands=False, include=None,
+                          exclude=None):
+        """Return the compile commands that `parse_database()` would parse,
+            in database order, as (directory, arguments) pairs. Arguments
+            are as in `parse_database()`."""
+        assert self._db is not None, 'no compilation database'
+        selected = PathFilter(include=include, exclude=exclude)
+        commands = []
+        seen = set()
+        for c in self._db.getAllCompileCommands() or ():
+            command = self._command(c)
+            file_path = os.path.normpath(os.path.join(command[0], c.filename))
+            if not selected(file_path):
+                continue
+            key = command if all_commands else file_path
+            if key not in seen:
+                seen.add(key)
+                commands.append(command)
+        return commands
+
+    def _parse_all(self, tasks, jobs, executor):
+        """Parse each task (a file path or a compile command) as a unit,
+            in parallel if requested, and merge the units in order."""
+        jobs = jobs or multiprocessing.cpu_count()
+        results = []
+        if jobs == 1 or len(tasks) <= 1:
+            for task in tasks:
+                if self._parse_task(task) is None:
+                    results.append(None)
+                else:
+                    results.append(self.global_scope)
+                self._sample_memory()
+        else:
+            for fragment in self.iter_fragments(tasks, jobs, executor):
+                if fragment is None:
+                    results.append(None)
+                else:
+                    self._link_fragment(fragment)
+                    results.append(self.global_scope)
+                self._sample_memory()
+        self.global_scope._afterpass()    # once, after all the units
+        return results
+
+    def iter_fragments(self, tasks, jobs=1, executor='processes'):
+        """Parse each task (a file path or a compile command) into a
+            `ModelFragment`, in parallel if requested, and yield them (or
+            None, for files without compile commands) in task order.
+            The model of this parser is left untouched.
+
+        Args:
+            tasks (list): The absolute file paths, or (directory,
+                arguments) commands, to parse.
+
+        Kwargs:
+            jobs (int): The number of workers, as in `parse_many()`.
+            executor (str): The kind of workers, as in `parse_many()`.
+        """
+        jobs = jobs or multiprocessing.cpu_count()
+        if jobs == 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield self.parse_fragment(task)
+            return
+        jobs = min(jobs, len(tasks))
+        if executor == 'threads':
+            pool = ThreadPool(jobs)
+            parse_fn = self.parse_fragment
+        elif executor == 'processes':
+            cache = self._cache
+            config = (CppAstParser.lib_path, CppAstParser.lib_file,
+                      CppAstParser.includes,
+                      getattr(self._db, 'db_path', None),
+                      cache and (cache.directory, cache.check),
+                      self.workspace, self.user_includes, self.parse_options,
+                      self.declarations_only, self.headers_once,
+                      self.depth_first, self.recycle_index, self.max_errors,
+                      self.path_filter.include, self.path_filter.exclude)
+            pool = multiprocessing.Pool(jobs, _init_worker, (config,))
+            parse_fn = _parse_in_worker
+        else:
+            raise ValueError('unknown executor: ' + executor)
+        try:
+            for fragment in pool.imap(parse_fn, tasks):
+                if executor == 'processes':
+                    fragment, stats = fragment
+                    if stats:
+                        self._cache.add_stats(stats)
+                    fragment = fragment and ModelFragment.loads(fragment)
+                yield fragment
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def memory_report(self):
+        """Return a one-line summary of the resident memory of this
+            process over the batches of units parsed so far (or None,
+            without samples, e.g. outside of Linux)."""
+        samples = self.memory_samples
+        if not samples:
+            return None
+        first = samples[0] / 1048576.0
+        last = samples[-1] / 1048576.0
+        peak = max(samples) / 1048576.0
+        growth = ((samples[-1] - samples[0]) / 1024.0 / (len(samples) - 1)
+                  if len(samples) > 1 else 0.0)
+        return ('memory: {} units, {:.1f} MB resident after the first, '
+                '{:.1f} MB after the last (peak {:.1f} MB), {:+.1f} KB per '
+                'unit').format(len(samples), first, last, peak, growth)
+
+    def _sample_memory(self):
+        size = _resident_size()
+        if size is not None:
+            self.memory_samples.append(size)
+
+    def _parse_task(self, task):
+        if isinstance(task, tuple):
+            return self._parse_command(task)
+        return self._parse_unit(task)
+
+    def get_ast(self, file_path, stream=None, tokens=True):
+        """Dump the AST of a file, one line per (workspace) cursor, with
+            its location, kind, spelling and, optionally, token count.
+
+            Lines are written to `stream` as cursors are visited, so that
+            dumps of large units need not be kept in memory.
+
+        Args:
+            file_path (str): The file to parse.
+
+        Kwargs:
+            stream (file): Where to write the dump. If not given, the dump
+                is returned as a string instead.
+            tokens (bool): Count the tokens of each cursor.
+
+        Returns:
+            The dump (as a string), or `stream` if one was given, or None
+                if the file has no compile commands.
+        """
         file_path = os.path.abspath(file_path)
+        out = stream if stream is not None else io.StringIO()
+        dump = partial(self._ast_dump, stream=out, tokens=tokens)
         if self._db is None:
-            return self._parse_without_db(file_path, just_ast=True)
-        return self._parse_from_db(file_path, just_ast=True)
+            result = self._parse_without_db(file_path, dump=dump)
+        else:
+            result = self._parse_from_db(file_path, dump=dump)
+        if result is None or stream is not None:
+            return result
+        return out.getvalue()[:-1]      # without the last line break
+
+    def _parse_unit(self, file_path, keep=False):
+        if self._db is None:
+            return self._parse_without_db(file_path, keep=keep)
+        return self._parse_from_db(file_path, keep=keep)
+
+    def parse_fragment(self, task):
+        """Parse a translation unit into a `ModelFragment` of its own,
+            with the `Index` of the current thread, and the settings of
+            this parser. The model of this parser is left untouched.
 
-    def _parse_from_db(self, file_path, just_ast=False):
+        Args:
+            task: The file to parse, or a (directory, arguments) compile
+                command.
+
+        Returns:
+            ModelFragment: The model of the unit, or None if the file has
+                no compile commands.
+        """
+        if not isinstance(task, tuple):
+            task = os.path.abspath(task)
+        parser = CppAstParser(workspace=self.workspace,
+                              user_includes=self.user_includes)
+        parser.path_filter = self.path_filter
+        parser.parse_options = self.parse_options
+        parser.declarations_only = self.declarations_only
+        parser.headers_once = self.headers_once
+        parser.depth_first = self.depth_first
+        parser.max_errors = self.max_errors
+        # which unit builds a header is decided by link(), in task order,
+        # rather than by whichever worker gets to it first
+        parser._unit_headers = {}
+        parser._digests = self._digests     # shared by threads
+        parser._db = self._db
+        parser._cache = self._cache
+        parser._index = _thread_index(self.recycle_index)
+        parser.data = _UnitData()
+        if parser._parse_task(task) is None:
+            return None
+        return ModelFragment(parser._main_file, parser.global_scope,
+                             parser.data.events, parser._file_entities,
+                             cursor_counts=parser.cursor_stats.counts,
+                             peak_builders=parser.peak_builders,
+                             diagnostics=parser.diagnostics,
+                             headers=parser._unit_headers)
+
+    def link(self, fragments, strict=False):
+        """Merge model fragments into the model of this parser, in order,
+            and link their entities to each other and to the rest of the
+            model.
+
+            As in a sequential parse, an entity defined more than once is
+            only kept the first time. Each duplicate is recorded as a
+            warning in `self.diagnostics` (category "Link Issue").
+            With `headers_once`, a header is only kept from the first
+            fragment that built it, as if later units had skipped it.
+
+        Args:
+            fragments: The `ModelFragment`s (or None, which are skipped).
+
+        Kwargs:
+            strict (bool): Raise `MultipleDefinitionError` on duplicate
+                definitions instead; the model is then only partly linked.
+
+        Returns:
+            CppGlobalScope: The global scope of the program model.
+        """
+        for fragment in fragments:
+            if fragment is not None:
+                self._link_fragment(fragment, strict=strict)
+        self.global_scope._afterpass()
+        return self.global_scope
+
+    def _link_fragment(self, fragment, strict=False):
+        """Move the entities of a fragment into the global scope, and link
+            them by replaying its recorded events."""
+        self.cursor_stats.add(fragment.cursor_counts)
+        self.peak_builders = max(self.peak_builders, fragment.peak_builders)
+        if fragment.diagnostics is not None:
+            self.diagnostics.merge(fragment.diagnostics)
+        unit_scope = fragment.scope
+        dropped = set()
+        built_before = set()    # headers that an earlier unit built
+        for path, key in (fragment.headers or {}).items():
+            if key in self._headers:
+                built_before.add(path)
+            else:
+                self._headers.add(key)
+        for path in built_before:
+            for codeobj in fragment.file_entities.get(path, ()):
+                dropped.add(id(codeobj))
+                _detach(codeobj)
+        for codeobj, arg in fragment.events:
+            if dropped and _is_within(codeobj, dropped):
+                continue
+            if isinstance(arg, bool):
+                try:
+                    self.data.register(codeobj, declaration=arg)
+                except MultipleDefinitionError as e:
+                    if strict:
+                        raise
+                    # as in a sequential parse, the duplicate is not built
+                    dropped.add(id(codeobj))
+                    _detach(codeobj)
+                    self.diagnostics.add(Diagnostic(
+                        fragment.unit, Diagnostics.WARNING, codeobj.file,
+                        codeobj.line, codeobj.column, str(e), "Link Issue"))
+            else:
+                self.data.reference(arg, codeobj)
+        for codeobj in unit_scope.walk_preorder():
+            if codeobj.parent is unit_scope:
+                codeobj.parent = self.global_scope
+            if codeobj.scope is unit_scope:
+                codeobj.scope = self.global_scope
+        for codeobj in unit_scope.children:
+            self.global_scope._add(codeobj)
+        built = {}
+        for path, objs in fragment.file_entities.items():
+            if path in built_before:
+                continue
+            objs = [codeobj for codeobj in objs if id(codeobj) not in dropped]
+            self._file_entities.setdefault(path, []).extend(objs)
+            built[path] = objs
+        if self.symbols is not None:
+            self.symbols.update(built)
+
+    def _unlink(self, codeobj, removed):
+        """Undo the links between an entity, removed from the model, and
+            the rest of the model. `removed` holds the ids of all removed
+            objects."""
+        data = self.data
+        for obj in codeobj.walk_preorder():
+            ref = getattr(obj, 'reference', None)
+            if isinstance(ref, CodeEntity):
+                _remove(ref.references, obj)
+            elif ref is not None:
+                _remove(data._refs.get(ref, []), obj)
+            if isinstance(obj, CodeOperator) and obj.is_assignment:
+                if obj.arguments and isinstance(obj.arguments[0],
+                                                CodeReference):
+                    var = obj.arguments[0].reference
+                    if isinstance(var, CodeVariable):
+                        _remove(var.writes, obj)
+            uid = getattr(obj, 'id', None)
+            if uid and data.entities.get(uid) is obj:
+                del data.entities[uid]
+                for ref in obj.references:
+                    if id(ref) not in removed:
+                        ref.reference = uid     # until defined again
+                        data._refs.setdefault(uid, []).append(ref)
+                obj.references = []
+
+    def _relink(self, ids):
+        """Fix the rest of the model after removing (and maybe building
+            again) the entities with some ids: their declarations point to
+            the current definition, if any (a declaration takes over the id
+            otherwise), and parameter summaries are discarded."""
+        for codeobj in self.global_scope.walk_preorder():
+            if isinstance(codeobj, CodeFunction):
+                invalidate_summary(codeobj)
+            if (not hasattr(codeobj, '_definition')
+                    or codeobj.id not in ids or codeobj.is_definition):
+                continue
+            entity = self.data.entities.get(codeobj.id)
+            if entity is None:
+                codeobj._definition = None
+                self.data.register(codeobj)
+                entity = codeobj
+            codeobj._definition = entity if entity.is_definition else None
+
+    # Relative paths are resolved by clang itself (-working-directory), rather
+    # than with os.chdir(), so that several threads can parse at once.
+
+    def _parse_from_db(self, file_path, dump=None, keep=False):
         # ----- command retrieval ---------------------------------------------
         cmd = self._db.getCompileCommands(file_path) or ()
         if not cmd:
             return None
+        seen = set()
         for c in cmd:
-            with cwd(os.path.join(self._db.db_path, c.directory)):
-                args = ['-I' + CppAstParser.includes] + list(c.arguments)[1:]
-                if self._index is None:
-                    self._index = clang.Index.create()
-
-                # ----- parsing and AST analysis ------------------------------
-                unit = self._index.parse(None, args)
-                self._check_compilation_problems(unit)
-                if just_ast:
-                    return self._ast_str(unit.cursor)
-                self._ast_analysis(unit.cursor)
-
-        self.global_scope._afterpass()
+            command = self._command(c)
+            if command in seen:
+                continue
+            seen.add(command)
+            # reparse() uses the first command of a file
+            result = self._parse_command(command, dump=dump,
+                                         keep=keep and len(seen) == 1)
+            if dump is not None:
+                return result
         return self.global_scope
 
-    def _parse_without_db(self, file_path, just_ast=False):
-        # ----- command retrieval ---------------------------------------------
-        with cwd(os.path.dirname(file_path)):
-            args = ['-I' + CppAstParser.includes]
-
-            for include_dir in self.user_includes:
-                args.append('-I' + include_dir)
+    def _command(self, compile_command):
+        """Return a compile command as a hashable (directory, arguments)
+            pair, without the compiler executable."""
+        directory = os.path.join(self._db.db_path, compile_command.directory)
+        return (directory, tuple(compile_command.arguments)[1:])
 
-            args.append(file_path)
-
-            if self._index is None:
-                self._index = clang.Index.create()
-
-            # ----- parsing and AST analysis ----------------------------------
-            unit = self._index.parse(None, args)
-            self._check_compilation_problems(unit)
-            if just_ast:
-                return self._ast_str(unit.cursor)
-            self._ast_analysis(unit.cursor)
-
-        self.global_scope._afterpass()
+    def _unit_command(self, file_path):
+        """Return the (first) command to parse a file with, or None."""
+        if self._db is None:
+            return self._default_command(file_path)
+        cmd = self._db.getCompileCommands(file_path)
+        return self._command(cmd[0]) if cmd else None
+
+    def _default_command(self, file_path):
+        arguments = ['-I' + include_dir for include_dir in self.user_includes]
+        arguments.append(file_path)
+        return (os.path.dirname(file_path), tuple(arguments))
+
+    def _args(self, command):
+        directory, arguments = command
+        return (['-working-directory=' + directory,
+                 '-I' + CppAstParser.includes] + list(arguments))
+
+    def _parse_command(self, command, dump=None, keep=False):
+        directory = command[0]
+        args = self._args(command)
+        keep = keep and dump is None
+
+        # ----- parsing and AST analysis --------------------------------------
+        # units loaded from the cache cannot be reparsed
+        unit, diagnostics = self._translation_unit(args, directory,
+                                                   load=not keep)
+        main_file = os.path.normpath(os.path.join(directory, unit.spelling))
+        try:
+            self._main_file = main_file
+            errors = self._collect_diagnostics(diagnostics, main_file)
+            if dump is not None:
+                return dump(unit.cursor, directory)
+            if self.max_errors is not None and errors > self.max_errors:
+                self.diagnostics.skip(main_file)
+            else:
+                self._ast_analysis(unit.cursor, directory, args=args)
+        finally:
+            if keep:
+                # kept alive for reparse(), in place of any older unit
+                kept = self._units.pop(main_file, None)
+                if kept is not None:
+                    _dispose(kept)
+                self._units[main_file] = unit
+            else:
+                # the model keeps no clang objects; free the unit right away
+                _dispose(unit)
         return self.global_scope
 
-    def _ast_analysis(self, top_cursor):
+    def _parse_without_db(self, file_path, dump=None, keep=False):
+        command = self._default_command(file_path)
+        return self._parse_command(command, dump=dump, keep=keep)
+
+    def _translation_unit(self, args, directory, load=True):
+        """Return a unit for some arguments, from the cache if possible
+            (and `load` is set), and its diagnostics, as from
+            `_unit_diagnostics()`."""
+        if self._index is None or (self.recycle_index and
+                                   self._index_units >= self.recycle_index):
+            # the old index is freed along with the last of its units
+            self._index = clang.Index.create()
+            self._index_units = 0
+        self._index_units += 1
+        options = self._options()
+        if self._cache is not None and load:
+            entry = self._cache.load(self._index, args, options=options)
+            if entry is not None:
+                return entry
+        unit = self._index.parse(None, args, options=options)
+        diagnostics = _unit_diagnostics(unit)
+        if self._cache is not None:
+            self._cache.store(unit, args, directory, options=options,
+                              diagnostics=diagnostics)
+        return unit, diagnostics
+
+    def _options(self):
+        if self.declarations_only:
+            return self.parse_options | CppAstParser.PARSE_SKIP_FUNCTION_BODIES
+        return self.parse_options
+
+    def _workspace_files(self, directory):
+        """Return a function that maps a cursor to the normalized path of
+            its file, if it is accepted by `self.path_filter`, or None
+            otherwise. Relative file names (as given to clang) are taken
+            from the working `directory`; units loaded from the cache
+            report absolute names instead."""
+        path_filter = self.path_filter
+        def workspace_file(name):
+            path = os.path.normpath(os.path.join(directory, name))
+            return path if path_filter(path) else None
+        return CursorFiles(workspace_file)
+
+    def _ast_analysis(self, top_cursor, directory, only=None, args=()):
         assert top_cursor.kind == CK.TRANSLATION_UNIT
         cppobj = self.global_scope
-        builders = [
-            CppTopLevelBuilder(c, cppobj, cppobj)
-            for c in top_cursor.get_children()
-            if c.location.file
-                    and c.location.file.name.startswith(self.workspace)
-        ]
-
-        queue = deque(builders)
+        workspace_file = self._workspace_files(directory)
+        main_file = os.path.normpath(os.path.join(directory,
+                                                  top_cursor.spelling))
+        macros = _macro_args(args)
+        # even without objects, the main file is built (see reparse())
+        self._file_entities.setdefault(main_file, [])
+        ingested = {}   # header -> whether an earlier unit built it
+        selected = []   # (top-level cursor, file)
+        for c in top_cursor.get_children():
+            path = workspace_file(c)
+            if path is None or (only is not None and path != only):
+                continue
+            if self.headers_once and path != main_file:
+                skip = ingested.get(path)
+                if skip is None:
+                    key = (path, self._digest(path), macros)
+                    if self._unit_headers is not None:
+                        self._unit_headers[path] = key  # see link()
+                        skip = False
+                    else:
+                        skip = key in self._headers
+                        self._headers.add(key)
+                    ingested[path] = skip
+                if skip:
+                    continue
+            selected.append((c, path))
+
+        if self.symbols is not None:
+            # the files of this unit, and how many objects they had before
+            built = dict((path, len(self._file_entities.get(path, ())))
+                         for path in set(path for _, path in selected))
+            if only is not None:
+                # the file changed: what it had before is gone
+                self.symbols.remove(only)
+                built.setdefault(only, len(self._file_entities.get(only, ())))
+
+        records = CursorRecords(top_cursor.translation_unit,
+                                self.cursor_stats)
+        if self.depth_first:
+            # one top-level cursor at a time, so that only its records
+            # are kept in memory
+            groups = [[top] for top in selected]
+        else:
+            groups = [selected]
+        for group in groups:
+            records.clear()
+            builders = []
+            files = {}      # top-level builder -> file
+            for c, path in group:
+                builder = CppTopLevelBuilder(records.extract(c), cppobj,
+                                             cppobj,
+                                             bodies=not self.declarations_only)
+                builders.append(builder)
+                files[builder] = path
+            self._run_builders(builders, files)
+        if self.symbols is not None:
+            self.symbols.update(dict(
+                (path, self._file_entities.get(path, [])[count:])
+                for path, count in built.items()))
+
+    def _run_builders(self, builders, files):
+        """Run builders, and those that they return, until all are done.
+            Either way, siblings are built in order, and each object is
+            added to its parent before the objects of its own builders."""
+        if self.depth_first:
+            pending = builders[::-1]
+            take = pending.pop
+        else:
+            pending = deque(builders)
+            take = pending.popleft
+        peak = len(pending)
 
-        while queue:
-            builder = queue.popleft()
+        while pending:
+            builder = take()
             result = builder.build(self.data)
 
             if result:
@@ -1025,69 +1837,300 @@ class CppAstParser(CodeAstParser):
                     builder.insert_method(cppobj)
                 else:
                     builder.parent._add(cppobj)
+                path = files.pop(builder, None)
+                if path is not None:
+                    self._file_entities.setdefault(path, []).append(cppobj)
 
-                queue.extend(builders)
+                if self.depth_first:
+                    pending.extend(reversed(builders))
+                else:
+                    pending.extend(builders)
+                peak = max(peak, len(pending))
+        self.peak_builders = max(self.peak_builders, peak)
 
-    def _ast_str(self, top_cursor):
-        assert top_cursor.kind == CK.TRANSLATION_UNIT
+    def _digest(self, file_path):
+        """Return a hash of the contents of a file, recomputed only when
+            its size or modification time change."""
+        try:
+            stat = os.stat(file_path)
+            stamp = (stat.st_size, stat.st_mtime)
+            memo = self._digests.get(file_path)
+            if memo is not None and memo[0] == stamp:
+                return memo[1]
+            with open(file_path, 'rb') as handle:
+                digest = hashlib.sha1(handle.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+        self._digests[file_path] = (stamp, digest)
+        return digest
 
-        lines = []
+    def _ast_dump(self, top_cursor, directory, stream, tokens=True):
+        """Write the AST of the workspace cursors of a unit to `stream`,
+            in preorder, and return the stream."""
+        assert top_cursor.kind == CK.TRANSLATION_UNIT
+        write = stream.write
+        cursor_str = self._cursor_str
+        workspace_file = self._workspace_files(directory)
         for cursor in top_cursor.get_children():
-            if (cursor.location.file
-                    and cursor.location.file.name.startswith(self.workspace)):
-                lines.append(self._cursor_str(cursor, 0))
-                indent = 0
-                stack = list(cursor.get_children())
-                stack.append(1)
-                while stack:
-                    c = stack.pop()
-                    if isinstance(c, int):
-                        indent += c
-                    else:
-                        lines.append(self._cursor_str(c, indent))
-                        stack.append(-1)
-                        stack.extend(c.get_children())
-                        stack.append(1)
-        return '\n'.join(lines)
-
-    @staticmethod
-    def _check_compilation_problems(translation_unit):
-        if translation_unit.diagnostics:
-            for diagnostic in translation_unit.diagnostics:
-                if diagnostic.severity >= clang.Diagnostic.Error:
-                    # logging.warning(diagnostic.spelling)
-                    print('WARNING', diagnostic.spelling)
+            if workspace_file(cursor) is None:
+                continue
+            write(cursor_str(cursor, 0, tokens))
+            write('\n')
+            # one iterator per level; the indent is the depth of the stack
+            stack = [iter(cursor.get_children())]
+            while stack:
+                c = next(stack[-1], None)
+                if c is None:
+                    stack.pop()
+                    continue
+                write(cursor_str(c, len(stack), tokens))
+                write('\n')
+                stack.append(iter(c.get_children()))
+        return stream
+
+    def _collect_diagnostics(self, diagnostics, main_file):
+        """Add the diagnostics of a unit (as from `_unit_diagnostics()`)
+            to `self.diagnostics`, under its main file. Return the number
+            of errors."""
+        errors = 0
+        for diagnostic in diagnostics:
+            if diagnostic[0] >= clang.Diagnostic.Error:
+                errors += 1
+            self.diagnostics.add(Diagnostic(main_file, *diagnostic))
+        return errors
 
     @staticmethod
-    def _cursor_str(cursor, indent):
+    def _cursor_str(cursor, indent, tokens=True):
         line = 0
         col = 0
         try:
-            if cursor.location.file:
-                line = cursor.location.line
-                col = cursor.location.column
+            location = cursor.location
+            if location.file:
+                line = location.line
+                col = location.column
         except ArgumentError as e:
             pass
         name = repr(cursor.kind)[11:]
         spell = cursor.spelling or '[no spelling]'
-        tokens = len(list(cursor.get_tokens()))
         prefix = indent * '| '
+        if not tokens:
+            return '{}[{}:{}] {}: {}'.format(prefix, line, col, name, spell)
         return '{}[{}:{}] {}: {} [{} tokens]'.format(prefix, line, col,
-                                                     name, spell, tokens)
+                                                     name, spell,
+                                                     token_count(cursor))
 
 
 ###############################################################################
 # Helpers
 ###############################################################################
 
-class cwd(object):
-    """Run a block of code from a specified working directory"""
-    def __init__(self, path):
-        self.dir = path
-
-    def __enter__(self):
-        self.old_dir = os.getcwd()
-        os.chdir(self.dir)
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        os.chdir(self.old_dir)
+class _UnitData(AnalysisData):
+    """Analysis data of a translation unit built in isolation.
+
+        Calls are recorded in order, as `(codeobj, declaration)` for
+        registrations and `(ref, refd_id)` for references, so that they
+        can be replayed later against the data of the whole program.
+    """
+    def __init__(self):
+        AnalysisData.__init__(self)
+        self.events = []
+
+    def register(self, codeobj, declaration=False):
+        self.events.append((codeobj, declaration))
+
+    def reference(self, refd_id, ref):
+        self.events.append((ref, refd_id))
+
+
+_MACRO_OPTIONS = ('-D', '-U', '-include', '-imacros', '-x')
+_MACRO_PREFIXES = _MACRO_OPTIONS + ('-std=', '-f')
+
+def _macro_args(args):
+    """Return the arguments that may change what a header expands to:
+        macro definitions, forced includes, language and feature flags."""
+    macros = []
+    args = iter(args)
+    for arg in args:
+        if arg in _MACRO_OPTIONS:
+            macros.append(arg + next(args, ''))
+        elif arg.startswith(_MACRO_PREFIXES):
+            macros.append(arg)
+    return tuple(macros)
+
+
+def _is_within(codeobj, ids):
+    while codeobj is not None:
+        if id(codeobj) in ids:
+            return True
+        codeobj = codeobj.parent
+    return False
+
+
+_BODY_LOOKAHEAD = (256, 32, 4, 1)   # characters after a declarator
+
+def _has_skipped_body(cursor):
+    """Tell whether a function, parsed with `PARSE_SKIP_FUNCTION_BODIES`,
+        had a body. libclang reports these as mere declarations, so look
+        at the tokens that follow the declarator."""
+    end = cursor.extent.end
+    if not end.file:
+        return False
+    unit = cursor.translation_unit
+    for span in _BODY_LOOKAHEAD:
+        limit = clang.SourceLocation.from_offset(unit, end.file,
+                                                 end.offset + span)
+        if limit.file and limit.file.name == end.file.name:
+            break
+    else:
+        return False
+    tokens = unit.get_tokens(extent=clang.SourceRange.from_locations(end,
+                                                                     limit))
+    for token in tokens:
+        if token.spelling in ('{', ':', 'try'):
+            return True
+        if token.spelling == '=':
+            # "= default" and "= delete" are definitions, "= 0" is not
+            token = next(tokens, None)
+            return token is not None and token.spelling != '0'
+        if token.spelling == ';':
+            return False
+    return False
+
+
+def _unit_diagnostics(unit):
+    """Return the diagnostics of a unit, as (severity, file, line, column,
+        message, category) tuples."""
+    diagnostics = []
+    for diagnostic in unit.diagnostics:
+        location = diagnostic.location
+        source_file = location.file
+        diagnostics.append((diagnostic.severity,
+                            source_file.name if source_file else None,
+                            location.line if source_file else None,
+                            location.column if source_file else None,
+                            diagnostic.spelling,
+                            diagnostic.category_name or None))
+    return diagnostics
+
+
+def _dispose(unit):
+    """Free a translation unit now, rather than when it is collected.
+        Its cursors must not be used afterwards."""
+    forget_tokens(unit)
+    clang.conf.lib.clang_disposeTranslationUnit(unit)
+    unit.obj = unit._as_parameter_ = None   # a no-op for __del__
+
+
+_PAGE_SIZE = None
+
+def _resident_size():
+    """Return the resident memory of this process, in bytes, or None if
+        it is not available (it is read from /proc/self/statm)."""
+    global _PAGE_SIZE
+    try:
+        with open('/proc/self/statm') as handle:
+            pages = int(handle.read().split()[1])
+        if _PAGE_SIZE is None:
+            _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+    return pages * _PAGE_SIZE
+
+
+def _detach(codeobj):
+    children = getattr(codeobj.parent, 'children', None)
+    if children is None:
+        children = getattr(codeobj.parent, 'members', [])
+    _remove(children, codeobj)
+
+
+def _remove(items, codeobj):
+    """Remove an object from a list, by identity."""
+    for i in range(len(items)):
+        if items[i] is codeobj:
+            del items[i]
+            return
+
+
+# ----- Workers ---------------------------------------------------------------
+
+_worker = None      # the CppAstParser of a worker process, for its settings
+
+def _init_worker(config):
+    global _worker
+    (lib_path, lib_file, includes, db_path, cache,
+     workspace, user_includes, parse_options, declarations_only,
+     headers_once, depth_first, recycle_index, max_errors,
+     include, exclude) = config
+    if not clang.Config.loaded:     # e.g. not inherited through fork()
+        if lib_file:
+            clang.Config.set_library_file(lib_file)
+        elif lib_path:
+            clang.Config.set_library_path(lib_path)
+    CppAstParser.lib_path = lib_path
+    CppAstParser.lib_file = lib_file
+    CppAstParser.includes = includes
+    if (db_path is not None      # not inherited through fork() either
+            and getattr(CppAstParser.database, 'db_path', None) != db_path):
+        CppAstParser.database = CompilationDatabase.from_directory(db_path)
+    # each worker counts its own cache statistics, from zero
+    CppAstParser.cache = cache and UnitCache(cache[0], check=cache[1])
+    _worker = CppAstParser(workspace=workspace, user_includes=user_includes,
+                           parse_options=parse_options,
+                           declarations_only=declarations_only,
+                           headers_once=headers_once,
+                           depth_first=depth_first,
+                           recycle_index=recycle_index,
+                           max_errors=max_errors,
+                           include=include, exclude=exclude)
+
+
+def _parse_in_worker(task):
+    """Return a pickled fragment (or None) and the cache statistics of the
+        parse (or None), to be added to those of the parent."""
+    cache = _worker._cache
+    before = cache.stats if cache else None
+    fragment = _worker.parse_fragment(task)
+    stats = cache and tuple(a - b for a, b in zip(cache.stats, before))
+    return (None if fragment is None else fragment.dumps()), stats
+
+
+_thread_data = threading.local()
+
+def _thread_index(recycle=0):
+    """Return the `Index` of the current thread (a new one every `recycle`
+        calls, if given); libclang does not support concurrent use of the
+        same index."""
+    index = getattr(_thread_data, 'index', None)
+    units = getattr(_thread_data, 'units', 0)
+    if index is None or (recycle and units >= recycle):
+        index = clang.Index.create()
+        _thread_data.index = index
+        units = 0
+    _thread_data.units = units + 1
+    return index
+
+
+# The shared unknown values must keep their identity across processes.
+_SOME_VALUES = dict((id(getattr(SomeValue, name)), name)
+                    for name in ('INTEGER', 'FLOATING', 'CHARACTER',
+                                 'STRING', 'BOOL'))
+
+class _ModelPickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        return _SOME_VALUES.get(id(obj))
+
+
+class _ModelUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return getattr(SomeValue, pid)
+
+
+def _dumps(obj):
+    stream = io.BytesIO()
+    _ModelPickler(stream, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return stream.getvalue()
+
+
+def _loads(data):
+    return _ModelUnpickler(io.BytesIO(data)).load()
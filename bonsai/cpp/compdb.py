@@ -0,0 +1,218 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+from __future__ import unicode_literals
+from builtins import object
+
+import io
+import json
+import os
+import pickle
+import shlex
+
+
+###############################################################################
+# Globals
+###############################################################################
+
+DATABASE_FILE = 'compile_commands.json'
+INDEX_SUFFIX = '.index'
+
+_CHUNK_SIZE = 1 << 20
+_SKIPPED = ' \t\r\n,'
+_QUOTES = ('"', "'", '\\')     # without these, split() is as good as shlex
+
+
+###############################################################################
+# Compilation Database
+###############################################################################
+
+class CompileCommand(object):
+    """A single entry of the compilation database.
+
+        Mirrors the attributes of `clang.cindex.CompileCommand` that bonsai
+        uses: `directory`, `filename` and `arguments` (the compiler first).
+        Entries with a `command` string are only split, with shell rules,
+        when their arguments are first needed.
+    """
+    __slots__ = ('directory', 'filename', '_arguments', '_command')
+
+    def __init__(self, directory, filename, arguments=None, command=None):
+        self.directory = directory
+        self.filename = filename
+        self._arguments = tuple(arguments) if arguments is not None else None
+        self._command = command
+
+    @property
+    def arguments(self):
+        if self._arguments is None:
+            command = self._command or ''
+            if any(c in command for c in _QUOTES):
+                self._arguments = tuple(shlex.split(command))
+            else:
+                self._arguments = tuple(command.split())
+            self._command = None
+        return self._arguments
+
+    def __reduce__(self):
+        return (CompileCommand, (self.directory, self.filename,
+                                 self._arguments, self._command))
+
+    def __repr__(self):
+        return 'CompileCommand({!r}, {!r})'.format(self.directory,
+                                                   self.filename)
+
+
+class CompilationDatabase(object):
+    """A `compile_commands.json` database, read without libclang.
+
+        This is meant as a drop-in replacement for
+        `clang.cindex.CompilationDatabase`, as used by `CppAstParser`.
+        The JSON file is decoded one entry at a time, and commands are
+        indexed by the normalized absolute path of their file.
+    """
+
+    def __init__(self, db_path, commands):
+        """Constructor for compilation databases.
+
+        Args:
+            db_path (str): The directory of the database.
+            commands (list): The `CompileCommand` entries, in file order.
+        """
+        self.db_path = db_path
+        self.commands = commands
+        self._index = {}
+        for command in commands:
+            file_path = os.path.normpath(os.path.join(command.directory,
+                                                      command.filename))
+            self._index.setdefault(file_path, []).append(command)
+
+    @classmethod
+    def from_directory(cls, db_path, cache=False):
+        """Load the database in a directory.
+
+        Args:
+            db_path (str): The directory containing `compile_commands.json`.
+
+        Kwargs:
+            cache (bool): Keep a pickled index next to the JSON file, and
+                use it instead while the JSON file is unchanged.
+        """
+        db_path = os.path.abspath(db_path)
+        json_path = os.path.join(db_path, DATABASE_FILE)
+        stat = os.stat(json_path)
+        stamp = (stat.st_size, stat.st_mtime)
+        index_path = json_path + INDEX_SUFFIX
+        if cache:
+            db = _load_index(index_path, stamp)
+            if db is not None:
+                return db
+        with io.open(json_path, encoding='utf-8') as stream:
+            db = cls(db_path, _read_commands(stream, db_path))
+        if cache:
+            try:
+                with open(index_path, 'wb') as handle:
+                    pickle.dump((stamp, db), handle, pickle.HIGHEST_PROTOCOL)
+            except (IOError, OSError):
+                pass    # e.g. a read-only build directory
+        return db
+
+    def getCompileCommands(self, file_path):
+        """Return the commands of a file, or None (as libclang does)."""
+        return self._index.get(os.path.normpath(file_path))
+
+    def getAllCompileCommands(self):
+        """Return all commands, in database order."""
+        return self.commands
+
+    def __len__(self):
+        return len(self.commands)
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+def _read_commands(stream, db_path):
+    directories = {}    # each directory is normalized (and stored) once
+    commands = []
+    for entry in _iter_array(stream):
+        directory = entry.get('directory', '')
+        normalized = directories.get(directory)
+        if normalized is None:
+            normalized = os.path.normpath(os.path.join(db_path, directory))
+            directories[directory] = normalized
+        commands.append(CompileCommand(normalized, entry['file'],
+                                       arguments=entry.get('arguments'),
+                                       command=entry.get('command')))
+    return commands
+
+
+def _iter_array(stream, chunk_size=_CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array, decoding them one at
+        a time from chunks of `stream`, rather than the whole text."""
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    opened = False
+    while True:
+        while pos < len(buf) and buf[pos] in _SKIPPED:
+            pos += 1
+        if pos == len(buf):
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                if opened:
+                    raise ValueError('unterminated JSON array')
+                return
+            buf = chunk
+            pos = 0
+            continue
+        if not opened:
+            if buf[pos] != '[':
+                raise ValueError('expected a JSON array')
+            opened = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            element, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield element
+
+
+def _load_index(index_path, stamp):
+    try:
+        with open(index_path, 'rb') as handle:
+            saved, db = pickle.load(handle)
+    except Exception:
+        return None     # missing, stale format or corrupted
+    return db if saved == stamp else None
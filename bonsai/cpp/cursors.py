@@ -0,0 +1,764 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+from __future__ import unicode_literals
+from builtins import object
+
+from array import array
+from ctypes import (POINTER, Structure, byref, c_char_p, c_int, c_uint,
+                    c_void_p, py_object)
+
+import clang.cindex as clang
+
+CK = clang.CursorKind
+
+
+###############################################################################
+# Cursor Records
+###############################################################################
+
+class CursorStats(object):
+    """Counts the cursor attributes that `CursorRecords` fetched from
+        libclang, and the reads that were served from their columns
+        (i.e. the libclang calls saved)."""
+
+    def __init__(self):
+        self.fetched = 0
+        self.cached = 0
+
+    @property
+    def counts(self):
+        return (self.fetched, self.cached)
+
+    def add(self, counts):
+        """Add the counts of another `CursorStats` (e.g. of a worker)."""
+        self.fetched += counts[0]
+        self.cached += counts[1]
+
+    def report(self):
+        """Return a one-line summary of the statistics."""
+        total = self.fetched + self.cached
+        rate = 100.0 * self.cached / total if total else 0.0
+        return ('cursors: {} attributes fetched, {} reads cached '
+                '({:.1f}% of calls saved)').format(self.fetched, self.cached,
+                                                   rate)
+
+
+class CursorRecords(object):
+    """The cursors of a translation unit, extracted into flat records.
+
+        Builders read the same few attributes of most cursors: kind,
+        spelling, location, types, USRs and children. Through `Cursor`,
+        each of those goes through a Python wrapper and, for most, a call
+        into libclang on every read. Instead, `extract()` walks a subtree
+        once, visiting the children of each cursor with
+        `clang_visitChildren`, and keeps one record per cursor, in
+        columns: its kind, parent and children. The children of a record
+        are consecutive records.
+
+        The other attributes are fetched on first read, with plain calls
+        into libclang, and kept in their columns: fetching all of them
+        up front costs more than it saves, since builders skip many
+        cursors. Strings are kept once, in a table, and columns refer to
+        them by id; types, USRs and file names are looked up once for
+        each type, declaration and file.
+
+        The plain calls need private parts of `clang.cindex` (see
+        `_Library`); with versions of it that lack them, records are
+        extracted through the public `Cursor` API instead, with the same
+        results, but fewer savings.
+    """
+
+    def __init__(self, unit, stats=None):
+        """Constructor for cursor records.
+
+        Args:
+            unit (clang.TranslationUnit): The unit of the cursors.
+
+        Kwargs:
+            stats (CursorStats): The counters to update.
+        """
+        self.unit = unit
+        self.stats = stats if stats is not None else CursorStats()
+        self.strings = ['']
+        self.type_table = [_Type('', None)]
+        self.file_table = []
+        self._string_ids = {'': 0}
+        self._type_ids = {None: 0}      # type key -> type id
+        self._usr_ids = {}              # declaration key -> string id
+        self._file_ids = {}             # file key -> file id
+        self._lib = _library()
+        self.clear()
+
+    def extract(self, cursor, parent=-1):
+        """Extract the records of a cursor and all of its descendants.
+            Return a `RecordCursor` for the given cursor."""
+        root = self._record(cursor, parent)
+        pending = [(root, cursor)]
+        while pending:
+            index, cursor = pending.pop()
+            children = self._lib.children(cursor, self.unit)
+            first = len(self.kinds)
+            for child in children:
+                pending.append((self._record(child, index), child))
+            self.first[index] = first
+            self.counts[index] = len(children)
+        unset = array('l', (_UNSET,)) * (len(self.kinds) - len(self.lines))
+        for column in self._lazy:
+            column.extend(unset)
+        self.extents.extend(None for i in range(len(unset)))
+        return RecordCursor(self, root)
+
+    def clear(self):
+        """Drop all records (e.g. once they have been built), but keep
+            the tables of strings, types, USRs and files."""
+        self.cursors = []               # clang.Cursor of each record
+        self.kinds = []                 # CursorKind of each record
+        self.parents = array('l')       # record index, or -1 (roots)
+        self.first = array('l')         # record index of the first child
+        self.counts = array('l')        # number of children
+        # the columns below are _UNSET until first read
+        self.spellings = array('l')     # string ids...
+        self.displaynames = array('l')
+        self.usrs = array('l')
+        self.definitions = array('l')   # ... or -1, for none
+        self.references = array('l')
+        self.types = array('l')         # type ids
+        self.result_types = array('l')
+        self.files = array('l')         # file ids, or -1, for none
+        self.lines = array('l')
+        self.columns = array('l')
+        self.extents = []               # clang.SourceRange, or None
+        self.arguments = {}             # record index -> argument indices
+        self._lazy = (self.spellings, self.displaynames, self.usrs,
+                      self.definitions, self.references, self.types,
+                      self.result_types, self.files, self.lines,
+                      self.columns)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    # ----- attributes --------------------------------------------------------
+
+    def spelling(self, index):
+        string_id = self.spellings[index]
+        if string_id == _UNSET:
+            string_id = self._string(
+                self._lib.spelling(self.cursors[index]))
+            self.spellings[index] = string_id
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return self.strings[string_id]
+
+    def displayname(self, index):
+        string_id = self.displaynames[index]
+        if string_id == _UNSET:
+            string_id = self._string(
+                self._lib.displayname(self.cursors[index]))
+            self.displaynames[index] = string_id
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return self.strings[string_id]
+
+    def usr(self, index):
+        string_id = self.usrs[index]
+        if string_id == _UNSET:
+            string_id = self.usrs[index] = self._usr_id(self.cursors[index])
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return self.strings[string_id] if string_id >= 0 else ''
+
+    def definition(self, index):
+        """Return the USR of the definition of a record, or None."""
+        string_id = self.definitions[index]
+        if string_id == _UNSET:
+            string_id = self._usr_id(
+                self._lib.definition(self.cursors[index]))
+            self.definitions[index] = string_id
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return self.strings[string_id] if string_id >= 0 else None
+
+    def referenced(self, index):
+        """Return the USR of the cursor that a record refers to, or None."""
+        string_id = self.references[index]
+        if string_id == _UNSET:
+            string_id = self._usr_id(
+                self._lib.referenced(self.cursors[index]))
+            self.references[index] = string_id
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return self.strings[string_id] if string_id >= 0 else None
+
+    def type(self, index):
+        type_id = self.types[index]
+        if type_id == _UNSET:
+            type_id = self.types[index] = self._type_id(
+                self._lib.type(self.cursors[index]))
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return self.type_table[type_id]
+
+    def result_type(self, index):
+        type_id = self.result_types[index]
+        if type_id == _UNSET:
+            type_id = self.result_types[index] = self._type_id(
+                self._lib.result_type(self.cursors[index]))
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return self.type_table[type_id]
+
+    def location(self, index):
+        """Return the (expansion) location of a record, as a triple of file
+            (or None), line and column."""
+        file_id = self.files[index]
+        if file_id == _UNSET:
+            key, line, column = self._lib.location(self.cursors[index])
+            file_id = self.files[index] = self._file_id(key)
+            self.lines[index] = line
+            self.columns[index] = column
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return (self.file_table[file_id] if file_id >= 0 else None,
+                self.lines[index], self.columns[index])
+
+    def extent(self, index):
+        extent = self.extents[index]
+        if extent is None:
+            extent = self.extents[index] = self._lib.extent(
+                self.cursors[index])
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return extent
+
+    def children(self, index):
+        """Return the indices of the children of a record."""
+        first = self.first[index]
+        return range(first, first + self.counts[index])
+
+    def argument_indices(self, index):
+        """Return the indices of the arguments of a call record."""
+        arguments = self.arguments.get(index)
+        if arguments is None:
+            arguments = self.arguments[index] = self._arguments(index)
+            self.stats.fetched += 1
+        else:
+            self.stats.cached += 1
+        return arguments
+
+    # ----- helpers -----------------------------------------------------------
+
+    def _record(self, cursor, parent):
+        index = len(self.kinds)
+        self.cursors.append(cursor)
+        self.kinds.append(self._lib.kind(cursor))
+        self.parents.append(parent)
+        self.first.append(index + 1)
+        self.counts.append(0)
+        return index
+
+    def _arguments(self, index):
+        lib = self._lib
+        cursor = self.cursors[index]
+        args = lib.arguments(cursor, self.unit)
+        if not args:
+            return ()
+        # arguments are (usually) children of the call, as the same
+        # expressions; match them by their expression key
+        positions = {}
+        for i in self.children(index):
+            positions.setdefault(lib.expression_key(self.cursors[i]), i)
+        arguments = []
+        for argument in args:
+            position = positions.get(lib.expression_key(argument))
+            if position is None:
+                position = self.extract(argument, parent=index).index
+            arguments.append(position)
+        return tuple(arguments)
+
+    def _string(self, text):
+        string_id = self._string_ids.get(text)
+        if string_id is None:
+            string_id = self._string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return string_id
+
+    def _type_id(self, clang_type):
+        lib = self._lib
+        key = lib.type_key(clang_type)
+        type_id = self._type_ids.get(key)
+        if type_id is not None:
+            return type_id
+        spelling = lib.type_spelling(clang_type)
+        canonical = lib.canonical_type(clang_type)
+        if lib.type_key(canonical) == key:
+            record = _Type(spelling, None)
+        else:
+            canonical_id = self._type_id(canonical)
+            record = _Type(spelling, self.type_table[canonical_id])
+        type_id = self._type_ids[key] = len(self.type_table)
+        self.type_table.append(record)
+        return type_id
+
+    def _usr_id(self, cursor):
+        if cursor is None:
+            return -1
+        key = self._lib.declaration_key(cursor)
+        usr_id = self._usr_ids.get(key) if key is not None else None
+        if usr_id is None:
+            usr_id = self._string(self._lib.usr(cursor))
+            if key is not None:
+                self._usr_ids[key] = usr_id
+        return usr_id
+
+    def _file_id(self, key):
+        if not key:
+            return -1
+        file_id = self._file_ids.get(key)
+        if file_id is None:
+            name = self._lib.file_name(key)
+            file_id = self._file_ids[key] = len(self.file_table)
+            self.file_table.append(_File(name))
+        return file_id
+
+
+class RecordCursor(object):
+    """A cursor of `CursorRecords`, read like a `clang.cindex.Cursor`.
+
+        Only the part of the `Cursor` interface that the builders use is
+        available. Related cursors are record cursors as well, except for
+        definitions and referenced cursors, of which only the USR is kept.
+    """
+
+    __slots__ = ('records', 'index', 'kind')
+
+    def __init__(self, records, index):
+        self.records = records
+        self.index = index
+        self.kind = records.kinds[index]
+
+    @property
+    def spelling(self):
+        return self.records.spelling(self.index)
+
+    @property
+    def displayname(self):
+        return self.records.displayname(self.index)
+
+    @property
+    def location(self):
+        return _Location(*self.records.location(self.index))
+
+    @property
+    def extent(self):
+        return self.records.extent(self.index)
+
+    @property
+    def translation_unit(self):
+        return self.records.unit
+
+    @property
+    def type(self):
+        return self.records.type(self.index)
+
+    @property
+    def result_type(self):
+        return self.records.result_type(self.index)
+
+    @property
+    def referenced(self):
+        return _declaration(self.records.referenced(self.index))
+
+    def get_usr(self):
+        return self.records.usr(self.index)
+
+    def get_definition(self):
+        return _declaration(self.records.definition(self.index))
+
+    def get_children(self):
+        records = self.records
+        return (RecordCursor(records, i) for i in records.children(self.index))
+
+    def get_arguments(self):
+        records = self.records
+        return (RecordCursor(records, i)
+                for i in records.argument_indices(self.index))
+
+    def get_tokens(self):
+        return self.records.unit.get_tokens(extent=self.extent)
+
+    def __repr__(self):
+        return 'RecordCursor({}, {!r})'.format(self.index, self.kind)
+
+
+class CursorFiles(object):
+    """Map cursors to a value computed from the file of their location.
+
+        `cursor.location.file.name` takes three libclang calls, and the
+        conversion of a string, for each cursor. Here, the file of a
+        cursor is only fetched as an opaque pointer (where `_Library` is
+        available), which is the same for all cursors of a file within a
+        translation unit, and the value of `function(file_name)` is
+        memoized by it. Cursors without a file map to None.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self._values = {}               # file key -> value
+        self._lib = _library()
+
+    def __call__(self, cursor):
+        key = self._lib.file_key(cursor)
+        if not key:
+            return None
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self.function(self._lib.file_name(key))
+            self._values[key] = value
+            return value
+
+
+class _Type(object):
+    __slots__ = ('spelling', 'canonical')
+
+    def __init__(self, spelling, canonical):
+        self.spelling = spelling
+        self.canonical = canonical  # None, for canonical types
+
+    def get_canonical(self):
+        return self.canonical if self.canonical is not None else self
+
+
+class _Declaration(object):
+    __slots__ = ('usr',)
+
+    def __init__(self, usr):
+        self.usr = usr
+
+    def get_usr(self):
+        return self.usr
+
+
+class _File(object):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class _Location(object):
+    __slots__ = ('file', 'line', 'column')
+
+    def __init__(self, source_file, line, column):
+        self.file = source_file
+        self.line = line
+        self.column = column
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+_UNSET = -2         # for columns of attributes not read yet
+
+_kinds = {}         # kind id -> CursorKind
+
+def _kind(kind_id):
+    kind = _kinds.get(kind_id)
+    if kind is None:
+        kind = _kinds[kind_id] = CK.from_id(kind_id)
+    return kind
+
+
+def _declaration(usr):
+    return _Declaration(usr) if usr is not None else None
+
+
+###############################################################################
+# libclang Compatibility
+###############################################################################
+
+# All uses of the private parts of `clang.cindex` are here: the ctypes
+# structures of `Cursor` and `Type`, the visitor callback type and the
+# function pointers of `conf.lib`. Extraction goes through one of two
+# libraries of the same interface: `_Library`, with plain calls into
+# libclang, or `_PublicLibrary`, with the public API only, for versions of
+# `clang.cindex` that lack (or have changed) those parts.
+
+class _Library(object):
+    """Plain prototypes of the libclang functions used for extraction,
+        without the result conversions of `clang.cindex`.
+
+        Raises AttributeError (or KeyError, TypeError) if the private
+        parts of `clang.cindex` that it needs are missing.
+    """
+
+    CURSOR_FIELDS = ('_kind_id', 'xdata', 'data')
+    TYPE_FIELDS = ('_kind_id', 'data')
+
+    def __init__(self, lib):
+        for structure, fields in ((clang.Cursor, self.CURSOR_FIELDS),
+                                  (clang.Type, self.TYPE_FIELDS)):
+            names = tuple(name for name, _ in structure._fields_)
+            if names != fields:
+                raise AttributeError('unknown layout of ' +
+                                     structure.__name__)
+        def function(name, restype, *argtypes):
+            f = lib._FuncPtr((name, lib))
+            f.restype = restype
+            f.argtypes = argtypes
+            return f
+        Cursor = clang.Cursor
+        CXString = _CXString
+        visitor = clang.callbacks['cursor_visit']
+        self._visitor = visitor(self._visit)
+        self.visitChildren = function('clang_visitChildren', c_uint, Cursor,
+                                      visitor, py_object)
+        self.isNull = function('clang_Cursor_isNull', c_int, Cursor)
+        self.getCursorSpelling = function('clang_getCursorSpelling',
+                                          CXString, Cursor)
+        self.getCursorDisplayName = function('clang_getCursorDisplayName',
+                                             CXString, Cursor)
+        self.getCursorUSR = function('clang_getCursorUSR', CXString, Cursor)
+        self.getCursorLocation = function('clang_getCursorLocation',
+                                          clang.SourceLocation, Cursor)
+        self.getExpansionLocation = function('clang_getExpansionLocation',
+                                             None, clang.SourceLocation,
+                                             POINTER(c_void_p),
+                                             POINTER(c_uint),
+                                             POINTER(c_uint),
+                                             POINTER(c_uint))
+        self.getFileName = function('clang_getFileName', CXString, c_void_p)
+        self.getCursorExtent = function('clang_getCursorExtent',
+                                        clang.SourceRange, Cursor)
+        self.getCursorType = function('clang_getCursorType', clang.Type,
+                                      Cursor)
+        self.getCursorResultType = function('clang_getCursorResultType',
+                                            clang.Type, Cursor)
+        self.getCanonicalType = function('clang_getCanonicalType',
+                                         clang.Type, clang.Type)
+        self.getTypeSpelling = function('clang_getTypeSpelling', CXString,
+                                        clang.Type)
+        self.getCursorDefinition = function('clang_getCursorDefinition',
+                                            Cursor, Cursor)
+        self.getCursorReferenced = function('clang_getCursorReferenced',
+                                            Cursor, Cursor)
+        self.getNumArguments = function('clang_Cursor_getNumArguments',
+                                        c_int, Cursor)
+        self.getArgument = function('clang_Cursor_getArgument', Cursor,
+                                    Cursor, c_uint)
+        self.getCString = function('clang_getCString', c_char_p, CXString)
+        self.disposeString = function('clang_disposeString', None, CXString)
+
+    @staticmethod
+    def _visit(child, parent, children):
+        children.append(child)
+        return 1    # CXChildVisit_Continue
+
+    def _text(self, cx_string):
+        """Return the text of a CXString, and dispose of it."""
+        text = self.getCString(cx_string)
+        self.disposeString(cx_string)
+        return text.decode('utf-8') if text else ''
+
+    # ----- cursors -----------------------------------------------------------
+
+    def children(self, cursor, unit):
+        children = []
+        self.visitChildren(cursor, self._visitor, children)
+        for child in children:
+            child._tu = unit
+        return children
+
+    def arguments(self, cursor, unit):
+        arguments = []
+        for i in range(max(self.getNumArguments(cursor), 0)):
+            argument = self.getArgument(cursor, i)
+            argument._tu = unit
+            arguments.append(argument)
+        return arguments
+
+    def kind(self, cursor):
+        return _kind(cursor._kind_id)
+
+    def spelling(self, cursor):
+        return self._text(self.getCursorSpelling(cursor))
+
+    def displayname(self, cursor):
+        return self._text(self.getCursorDisplayName(cursor))
+
+    def usr(self, cursor):
+        return self._text(self.getCursorUSR(cursor))
+
+    def definition(self, cursor):
+        """Return the definition of a cursor, or None."""
+        cursor = self.getCursorDefinition(cursor)
+        return None if self.isNull(cursor) else cursor
+
+    def referenced(self, cursor):
+        """Return the cursor that a cursor refers to, or None."""
+        cursor = self.getCursorReferenced(cursor)
+        return None if self.isNull(cursor) else cursor
+
+    def declaration_key(self, cursor):
+        return (cursor._kind_id, cursor.data[0])
+
+    def expression_key(self, cursor):
+        return cursor.data[1]   # the statement pointer
+
+    def location(self, cursor):
+        """Return the (expansion) location of a cursor, as a triple of
+            file key (or None), line and column."""
+        source_file = c_void_p()
+        line = c_uint()
+        column = c_uint()
+        self.getExpansionLocation(self.getCursorLocation(cursor),
+                                  byref(source_file), byref(line),
+                                  byref(column), None)
+        return source_file.value, line.value, column.value
+
+    def file_key(self, cursor):
+        source_file = c_void_p()
+        self.getExpansionLocation(self.getCursorLocation(cursor),
+                                  byref(source_file), None, None, None)
+        return source_file.value
+
+    def file_name(self, key):
+        return self._text(self.getFileName(key))
+
+    def extent(self, cursor):
+        return self.getCursorExtent(cursor)
+
+    # ----- types -------------------------------------------------------------
+
+    def type(self, cursor):
+        return self.getCursorType(cursor)
+
+    def result_type(self, cursor):
+        return self.getCursorResultType(cursor)
+
+    def type_key(self, clang_type):
+        # types are the same if they have the same (opaque) QualType
+        return clang_type.data[0]
+
+    def type_spelling(self, clang_type):
+        return self._text(self.getTypeSpelling(clang_type))
+
+    def canonical_type(self, clang_type):
+        return self.getCanonicalType(clang_type)
+
+
+class _PublicLibrary(object):
+    """The interface of `_Library`, through the public API of
+        `clang.cindex`."""
+
+    def children(self, cursor, unit):
+        return list(cursor.get_children())
+
+    def arguments(self, cursor, unit):
+        return list(cursor.get_arguments())
+
+    def kind(self, cursor):
+        return cursor.kind
+
+    def spelling(self, cursor):
+        return cursor.spelling or ''
+
+    def displayname(self, cursor):
+        return cursor.displayname or ''
+
+    def usr(self, cursor):
+        return cursor.get_usr() or ''
+
+    def definition(self, cursor):
+        return cursor.get_definition()
+
+    def referenced(self, cursor):
+        return cursor.referenced
+
+    def declaration_key(self, cursor):
+        return None     # USRs are not memoized
+
+    def expression_key(self, cursor):
+        extent = cursor.extent
+        return (cursor.kind, extent.start.offset, extent.end.offset)
+
+    def location(self, cursor):
+        location = cursor.location
+        source_file = location.file
+        return (source_file.name if source_file else None, location.line,
+                location.column)
+
+    def file_key(self, cursor):
+        source_file = cursor.location.file
+        return source_file.name if source_file else None
+
+    def file_name(self, key):
+        return key
+
+    def extent(self, cursor):
+        return cursor.extent
+
+    def type(self, cursor):
+        return cursor.type
+
+    def result_type(self, cursor):
+        return cursor.result_type
+
+    def type_key(self, clang_type):
+        return (clang_type.spelling, clang_type.get_canonical().spelling)
+
+    def type_spelling(self, clang_type):
+        return clang_type.spelling
+
+    def canonical_type(self, clang_type):
+        return clang_type.get_canonical()
+
+
+class _CXString(Structure):
+    # as `clang.cindex._CXString`, but disposed of explicitly (by `_text`)
+    _fields_ = [('data', c_void_p), ('flags', c_int)]
+
+
+_lib = None
+
+def _library():
+    global _lib
+    if _lib is None:
+        try:
+            _lib = _Library(clang.conf.lib)
+        except (AttributeError, KeyError, TypeError):
+            _lib = _PublicLibrary()
+    return _lib
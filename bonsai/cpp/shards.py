@@ -0,0 +1,334 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+from __future__ import unicode_literals
+from builtins import range
+
+import hashlib
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+
+from ..model import CodeEntity
+from .cache import replace_file
+from .clang_parser import ModelFragment
+
+
+###############################################################################
+# Globals
+###############################################################################
+
+METHODS = ('hash', 'cost')
+
+FORMAT = 1      # of shard files
+
+_SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.m', '.mm')
+
+
+###############################################################################
+# Sharding
+###############################################################################
+
+# A sharded run splits the (selected) commands of the compilation database
+# among N shards, each parsed on its own (e.g. on another machine). Each shard
+# writes the model fragments of its units to a shard file, along with the
+# position of each unit in the database. Merging links the fragments of all
+# shards in that order, which builds the same model as a single run.
+
+def parse_shard(spec):
+    """Return the (index, count) of a "I/N" shard spec, with 0 <= I < N."""
+    try:
+        index, count = (int(n) for n in spec.split('/'))
+    except ValueError:
+        raise ValueError('shards are given as I/N, not ' + repr(spec))
+    if not 0 <= index < count:
+        raise ValueError('no shard {} of {}'.format(index, count))
+    return index, count
+
+
+def select_shard(commands, index, count, by='hash', root=None):
+    """Return the commands of a shard, as (position, command) pairs, in
+        database order.
+
+        Each shard selects its own commands from the same list, so the
+        partition must be deterministic: by 'hash', a command goes to the
+        shard given by a hash of its source file, relative to `root`;
+        by 'cost', commands are spread so that shards get about the same
+        estimated cost (the size of the source file), largest first.
+        Either way, checkouts of the same sources at different places
+        (e.g. on different machines) agree on the partition.
+
+    Args:
+        commands (list): The (directory, arguments) commands of the run.
+        index (int): The shard to select, from 0.
+        count (int): The number of shards.
+
+    Kwargs:
+        by (str): How to partition the commands ('hash' or 'cost').
+        root (str): The directory of the compilation database.
+    """
+    if by == 'hash':
+        shards = [_hash(command, root) % count for command in commands]
+    elif by == 'cost':
+        shards = _balance([_cost(command) for command in commands], count)
+    else:
+        raise ValueError('unknown shard method: ' + by)
+    return [(position, command)
+            for position, (command, shard) in enumerate(zip(commands, shards))
+            if shard == index]
+
+
+def run_shard(parser, path, index, count, by='hash', jobs=1,
+              executor='processes', **selection):
+    """Parse one shard of the compilation database of a parser, and write
+        the fragments of its units to a shard file. Return the number of
+        units of the shard.
+
+    Args:
+        parser (CppAstParser): The parser, with the settings of the run.
+            Its own model is left untouched.
+        path (str): The shard file to write.
+        index (int): The shard to parse, from 0.
+        count (int): The number of shards.
+
+    Kwargs:
+        by (str): How to partition the commands ('hash' or 'cost').
+        jobs (int): The number of workers, as in `parse_many()`.
+        executor (str): The kind of workers, as in `parse_many()`.
+        selection: Passed on to `parser.database_commands()`.
+    """
+    selected = select_shard(parser.database_commands(**selection),
+                            index, count, by=by, root=parser.database_root)
+    fragments = parser.iter_fragments([command for _, command in selected],
+                                      jobs, executor)
+    positions = [position for position, _ in selected]
+    write_shard(path, index, count, zip(positions, fragments))
+    return len(selected)
+
+
+def write_shard(path, index, count, fragments):
+    """Write a shard file, one fragment at a time.
+
+    Args:
+        path (str): The shard file.
+        index (int): The shard, from 0.
+        count (int): The number of shards.
+        fragments: (position, `ModelFragment` or None) pairs.
+    """
+    temp = '{}.{}'.format(path, os.getpid())
+    try:
+        with open(temp, 'wb') as handle:
+            pickle.dump((FORMAT, index, count), handle,
+                        pickle.HIGHEST_PROTOCOL)
+            for position, fragment in fragments:
+                data = fragment.dumps() if fragment is not None else None
+                pickle.dump((position, data), handle, pickle.HIGHEST_PROTOCOL)
+        replace_file(temp, path)    # complete shard files only
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def read_shard(path):
+    """Return the (index, count) of a shard file, and an iterator over its
+        (position, `ModelFragment` or None) pairs."""
+    handle = open(path, 'rb')
+    try:
+        header = pickle.load(handle)
+    except Exception:
+        handle.close()
+        raise
+    if header[0] != FORMAT:
+        handle.close()
+        raise ValueError('unknown shard file format: ' + path)
+    return header[1:], _fragments(handle)
+
+
+def merge(parser, paths, strict=False):
+    """Link the fragments of the shard files of a run into the model of a
+        parser, in database order, and return its global scope.
+
+    Args:
+        parser (CppAstParser): The parser to link the fragments into.
+        paths (list): One shard file for each shard of the run.
+
+    Kwargs:
+        strict (bool): As in `CppAstParser.link()`.
+    """
+    shards = {}
+    counts = set()
+    for path in paths:
+        (index, count), fragments = read_shard(path)
+        if index in shards:
+            raise ValueError('shard {} given twice'.format(index))
+        shards[index] = fragments
+        counts.add(count)
+    if len(counts) > 1:
+        raise ValueError('shard files of different runs')
+    missing = [str(i) for i in range(counts.pop() if counts else 0)
+               if i not in shards]
+    if missing:
+        raise ValueError('missing shards: ' + ', '.join(missing))
+    merged = heapq.merge(*shards.values())  # positions are all distinct
+    return parser.link((fragment for _, fragment in merged), strict=strict)
+
+
+def simulate(make_parser, count, by='hash', directory=None, jobs=1,
+             executor='processes', **selection):
+    """Run all the shards of a run, one after the other, in this process,
+        merge them, and compare the merged model with that of a single
+        (unsharded) run.
+
+    Args:
+        make_parser: A function that returns a new `CppAstParser`, with
+            the settings of the run.
+        count (int): The number of shards.
+
+    Kwargs:
+        by (str): How to partition the commands ('hash' or 'cost').
+        directory (str): Where to write the shard files. By default, a
+            temporary directory, removed afterwards.
+        jobs (int): The number of workers of each shard.
+        executor (str): The kind of workers of each shard.
+        selection: Passed on to `database_commands()`.
+
+    Returns:
+        tuple: The merged parser, the single run parser, and the first
+            line where their models differ (or None, if they are equal).
+    """
+    temp = directory is None
+    if temp:
+        directory = tempfile.mkdtemp(prefix='bonsai-shards-')
+    try:
+        paths = []
+        for index in range(count):
+            path = os.path.join(directory,
+                                'shard-{}-of-{}.bonsai'.format(index, count))
+            run_shard(make_parser(), path, index, count, by=by, jobs=jobs,
+                      executor=executor, **selection)
+            paths.append(path)
+        merged = make_parser()
+        merge(merged, paths)
+    finally:
+        if temp:
+            shutil.rmtree(directory, ignore_errors=True)
+    single = make_parser()
+    single.parse_database(jobs=jobs, executor=executor, **selection)
+    return merged, single, first_difference(merged.global_scope,
+                                            single.global_scope)
+
+
+def first_difference(scope, other):
+    """Return the first line (as from `model_lines()`) where two models
+        differ, or None, if they are equal."""
+    lines = model_lines(scope)
+    others = model_lines(other)
+    for line in lines:
+        if line != next(others, None):
+            return line
+    return next(others, None)
+
+
+def model_lines(scope):
+    """Yield a line for each object of a model, in preorder, with its
+        depth, class, name, location, id and reference (by id)."""
+    stack = [(scope, 0)]
+    while stack:
+        codeobj, depth = stack.pop()
+        ref = getattr(codeobj, 'reference', None)
+        if isinstance(ref, CodeEntity):
+            ref = getattr(ref, 'id', None)
+        yield '{}{} {!r} {}:{}:{} {!r} -> {!r}'.format(
+            '| ' * depth, type(codeobj).__name__,
+            getattr(codeobj, 'name', None), codeobj.file, codeobj.line,
+            codeobj.column, getattr(codeobj, 'id', None), ref)
+        stack.extend((child, depth + 1)
+                     for child in reversed(list(codeobj._children())))
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+def _fragments(handle):
+    with handle:
+        while True:
+            try:
+                position, data = pickle.load(handle)
+            except EOFError:
+                return
+            yield position, (ModelFragment.loads(data)
+                             if data is not None else None)
+
+
+def _hash(command, root=None):
+    """Hash the source file of a command, relative to `root` (or the
+        arguments, without one), so that hashes do not depend on where
+        the sources are."""
+    directory, arguments = command
+    source = _source(command)
+    if source is not None:
+        key = os.path.relpath(source, root) if root else source
+    else:
+        key = '\0'.join(arguments)
+        if root:
+            key = key.replace(root, '')
+    key = key.replace(os.sep, '/').encode('utf-8')
+    return int(hashlib.sha1(key).hexdigest()[:15], 16)
+
+
+def _cost(command):
+    """Estimate the cost of a command by the size of its source file."""
+    source = _source(command)
+    if source is not None:
+        try:
+            return os.path.getsize(source)
+        except OSError:
+            pass
+    return 0
+
+
+def _source(command):
+    """Return the (normalized) path of the source file of a command."""
+    directory, arguments = command
+    for arg in reversed(arguments):
+        if os.path.splitext(arg)[1].lower() in _SOURCE_EXTENSIONS:
+            return os.path.normpath(os.path.join(directory, arg))
+    return None
+
+
+def _balance(costs, count):
+    """Assign each cost to a shard, greedily, the largest costs first, to
+        the shard with the least cost so far (the lowest, on ties)."""
+    loads = [(0, shard) for shard in range(count)]
+    shards = [None] * len(costs)
+    for i in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, shard = heapq.heappop(loads)
+        shards[i] = shard
+        heapq.heappush(loads, (load + costs[i], shard))
+    return shards
@@ -0,0 +1,227 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+from __future__ import unicode_literals
+from builtins import object
+from past.builtins import basestring
+
+from collections import namedtuple
+import os
+import sqlite3
+
+from ..model import CodeClass, CodeFunction, CodeGlobalScope, CodeNamespace
+
+
+###############################################################################
+# Symbol Database
+###############################################################################
+
+Symbol = namedtuple("Symbol", ("usr", "kind", "name", "qualified_name",
+                               "file", "line", "column", "definition"))
+
+Reference = namedtuple("Reference", ("usr", "name", "file", "line",
+                                     "column"))
+
+
+class SymbolDatabase(object):
+    """A persistent table of the symbols of a program, in SQLite.
+
+        For each file, it holds the declarations (and definitions) of the
+        entities built from it, by USR, with their kind, name, qualified
+        name and location, and the references it makes to other entities,
+        again by USR, with their location. The first time that a unit
+        builds a file, the rows of the file are replaced; further units
+        that build it (e.g. a shared header) only add what is new. This
+        keeps the database up to date across runs, and it can be queried
+        (e.g. to go to a definition, or to find references) without
+        parsing anything.
+
+        Out-of-line definitions (e.g. `void C::m() {}`) are qualified as
+        much as their declarations are.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS declarations (
+            usr TEXT NOT NULL, kind TEXT, name TEXT, qualified_name TEXT,
+            file TEXT NOT NULL, line INTEGER, col INTEGER,
+            definition INTEGER NOT NULL,
+            UNIQUE (usr, file, line, col, definition));
+        CREATE TABLE IF NOT EXISTS refs (
+            usr TEXT NOT NULL, name TEXT,
+            file TEXT NOT NULL, line INTEGER, col INTEGER,
+            UNIQUE (usr, file, line, col));
+        CREATE INDEX IF NOT EXISTS declarations_name
+            ON declarations (qualified_name);
+        CREATE INDEX IF NOT EXISTS declarations_file ON declarations (file);
+        CREATE INDEX IF NOT EXISTS refs_file ON refs (file);
+    """
+
+    def __init__(self, path):
+        """Constructor for symbol databases.
+
+        Args:
+            path (str): The database file. It is created if needed.
+        """
+        self.path = os.path.abspath(path)
+        self.files = 0          # files stored by this instance
+        self.declarations = 0   # and their declarations
+        self.references = 0     # and their references
+        self._stored = set()    # files replaced by this instance
+        self._connection = sqlite3.connect(self.path)
+        self._connection.executescript(SymbolDatabase.SCHEMA)
+
+    def update(self, file_entities):
+        """Store the symbols of the files of a unit.
+
+        Args:
+            file_entities (dict): For each (normalized) file, the
+                top-level objects built from it.
+        """
+        declarations = []
+        references = []
+        for path, objs in file_entities.items():
+            for codeobj in objs:
+                for obj in codeobj.walk_preorder():
+                    usr = getattr(obj, "id", None)
+                    if usr and isinstance(usr, basestring):
+                        definition = getattr(obj, "is_definition", True)
+                        declarations.append((
+                            usr, _kind(obj), obj.name, _qualified_name(obj),
+                            path, obj.line, obj.column,
+                            int(bool(definition))))
+                    ref = getattr(obj, "reference", None)
+                    if ref is not None and not isinstance(ref, basestring):
+                        ref = getattr(ref, "id", None)
+                    if ref:
+                        references.append((ref, obj.name, path,
+                                           obj.line, obj.column))
+        files = [(path,) for path in file_entities
+                 if path not in self._stored]
+        with self._connection as db:
+            db.executemany("DELETE FROM declarations WHERE file = ?", files)
+            db.executemany("DELETE FROM refs WHERE file = ?", files)
+            db.executemany("INSERT OR IGNORE INTO declarations VALUES "
+                           "(?, ?, ?, ?, ?, ?, ?, ?)", declarations)
+            db.executemany("INSERT OR IGNORE INTO refs VALUES "
+                           "(?, ?, ?, ?, ?)", references)
+            # the longest known qualified name, for all rows of a symbol
+            db.executemany(
+                "UPDATE declarations SET qualified_name = ("
+                " SELECT d.qualified_name FROM declarations AS d"
+                " WHERE d.usr = declarations.usr"
+                " ORDER BY length(d.qualified_name) DESC LIMIT 1)"
+                " WHERE usr = ?", set((row[0],) for row in declarations))
+        self._stored.update(path for path, in files)
+        self.files += len(files)
+        self.declarations += len(declarations)
+        self.references += len(references)
+
+    def remove(self, file_path):
+        """Forget the symbols of a file (e.g. one that was deleted, or is
+            about to be stored anew)."""
+        self._stored.add(file_path)
+        with self._connection as db:
+            db.execute("DELETE FROM declarations WHERE file = ?",
+                       (file_path,))
+            db.execute("DELETE FROM refs WHERE file = ?", (file_path,))
+
+    def declarations_of(self, usr, definition=None):
+        """Return the declarations of a symbol, as `Symbol`s.
+
+        Kwargs:
+            definition (bool): Only definitions (True), or only mere
+                declarations (False).
+        """
+        query = ("SELECT usr, kind, name, qualified_name, file, line, col,"
+                 " definition FROM declarations WHERE usr = ?")
+        args = (usr,)
+        if definition is not None:
+            query += " AND definition = ?"
+            args += (int(bool(definition)),)
+        return [Symbol(*row[:-1] + (bool(row[-1]),))
+                for row in self._connection.execute(
+                    query + " ORDER BY file, line, col", args)]
+
+    def definition_of(self, usr):
+        """Return the definition of a symbol, as a `Symbol`, or None."""
+        found = self.declarations_of(usr, definition=True)
+        return found[0] if found else None
+
+    def references_to(self, usr):
+        """Return the references to a symbol, as `Reference`s."""
+        return [Reference(*row) for row in self._connection.execute(
+            "SELECT usr, name, file, line, col FROM refs WHERE usr = ?"
+            " ORDER BY file, line, col", (usr,))]
+
+    def lookup(self, name):
+        """Return the USRs of the symbols with a (qualified) name."""
+        return [row[0] for row in self._connection.execute(
+            "SELECT DISTINCT usr FROM declarations"
+            " WHERE qualified_name = ? OR name = ? ORDER BY usr",
+            (name, name))]
+
+    def symbols_in(self, file_path):
+        """Return the declarations of a file, as `Symbol`s."""
+        return [Symbol(*row[:-1] + (bool(row[-1]),))
+                for row in self._connection.execute(
+                    "SELECT usr, kind, name, qualified_name, file, line, col,"
+                    " definition FROM declarations WHERE file = ?"
+                    " ORDER BY line, col", (file_path,))]
+
+    def close(self):
+        self._connection.close()
+
+    def report(self):
+        """Return a one-line summary of what was stored."""
+        return ("symbol database: {} files stored, with {} declarations "
+                "and {} references").format(self.files, self.declarations,
+                                            self.references)
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+def _kind(codeobj):
+    """Return the kind of an entity, e.g. "function" for `CppFunction`."""
+    name = type(codeobj).__name__
+    for prefix in ("Cpp", "Code"):
+        if name.startswith(prefix):
+            return name[len(prefix):].lower()
+    return name.lower()
+
+
+_SCOPES = (CodeNamespace, CodeClass, CodeFunction)
+
+def _qualified_name(codeobj):
+    """Return the name of an entity, prefixed by those of its enclosing
+        namespaces, classes and functions (e.g. "ns::C::method")."""
+    names = [codeobj.name]
+    scope = getattr(codeobj, "member_of", None) or codeobj.parent
+    while scope is not None and not isinstance(scope, CodeGlobalScope):
+        if isinstance(scope, _SCOPES):
+            names.append(scope.name)
+        scope = getattr(scope, "member_of", None) or scope.parent
+    return "::".join(reversed(names))
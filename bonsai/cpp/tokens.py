@@ -0,0 +1,201 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+from __future__ import unicode_literals
+from builtins import object
+
+from bisect import bisect_left, bisect_right
+from ctypes import POINTER, byref, c_uint, memmove, sizeof
+import threading
+import weakref
+
+import clang.cindex as clang
+
+
+###############################################################################
+# Token Tables
+###############################################################################
+
+class TokenTable(object):
+    """The tokens of a translation unit, lexed once per file.
+
+        `cursor.get_tokens()` lexes the extent of a cursor anew on each
+        call, and wraps each token in a Python object. Instead, each file
+        is tokenized once, up to the end of its last top-level declaration,
+        and the tokens of a cursor are found by binary search. Tokens are
+        only spelled when first asked for.
+
+        Locations are compared in their raw encoding (as in the `int_data`
+        of libclang's structures), which orders all files of a unit and
+        flags macro locations. Cursors that start or end within a macro
+        are still lexed by libclang, for the same tokens as before.
+    """
+
+    def __init__(self, unit):
+        """Constructor for token tables.
+
+        Args:
+            unit (clang.TranslationUnit): The unit to tokenize. It is not
+                referenced by the table.
+        """
+        self._starts = []   # sorted raw locations of the start of files
+        self._files = {}    # raw start -> _FileTokens
+        self.lexed = 0      # tokens lexed, in files
+        self.spelled = 0    # tokens of those that were spelled
+        self.served = 0     # cursors served from the table
+        self.missed = 0     # cursors lexed by libclang instead
+        files = {}          # file name -> _FileTokens
+        for cursor in unit.cursor.get_children():
+            extent = cursor.extent
+            end = extent.end_int_data
+            if (extent.begin_int_data | end) & _MACRO_BIT:
+                continue
+            source_file = extent.start.file
+            if not source_file:
+                continue
+            entry = files.get(source_file.name)
+            if entry is None:
+                start = clang.SourceLocation.from_offset(unit, source_file, 0)
+                entry = _FileTokens(source_file, start.int_data)
+                files[source_file.name] = entry
+                self._files[entry.start] = entry
+            entry.limit = max(entry.limit, end)
+        self._starts = sorted(self._files)
+
+    def spellings(self, cursor):
+        """Return the spellings of the tokens of a cursor, as a list."""
+        found = self._find(cursor)
+        if found is None:
+            return [token.spelling for token in cursor.get_tokens()]
+        entry, i, j = found
+        spellings = entry.spellings
+        if None in spellings[i:j]:
+            spell = clang.conf.lib.clang_getTokenSpelling
+            unit = cursor.translation_unit
+            for k in range(i, j):
+                if spellings[k] is None:
+                    spellings[k] = spell(unit, entry.tokens[k])
+                    self.spelled += 1
+        return spellings[i:j]
+
+    def count(self, cursor):
+        """Return the number of tokens of a cursor."""
+        found = self._find(cursor)
+        if found is None:
+            return sum(1 for token in cursor.get_tokens())
+        return found[2] - found[1]
+
+    def _find(self, cursor):
+        """Return the tokens of a file and the range of those of a cursor,
+            or None, if the cursor is not covered by the table."""
+        extent = cursor.extent
+        begin = extent.begin_int_data
+        end = extent.end_int_data
+        i = bisect_right(self._starts, begin) - 1
+        if i >= 0 and not (begin | end) & _MACRO_BIT:
+            entry = self._files[self._starts[i]]
+            if end <= entry.limit:
+                if entry.locations is None:
+                    self._lex(entry, cursor.translation_unit)
+                self.served += 1
+                return (entry, bisect_left(entry.locations, begin),
+                        bisect_left(entry.locations, end))
+        self.missed += 1
+        return None
+
+    def _lex(self, entry, unit):
+        lib = clang.conf.lib
+        extent = clang.SourceRange.from_locations(
+            clang.SourceLocation.from_offset(unit, entry.source_file, 0),
+            clang.SourceLocation.from_offset(unit, entry.source_file,
+                                             entry.limit - entry.start))
+        tokens = POINTER(clang.Token)()
+        count = c_uint()
+        lib.clang_tokenize(unit, extent, byref(tokens), byref(count))
+        n = count.value
+        # tokens are plain values (that point into the unit), so keep a
+        # copy of them, that Python owns, and free libclang's array now
+        entry.tokens = (clang.Token * n)()
+        if n:
+            memmove(entry.tokens, tokens, n * sizeof(clang.Token))
+            lib.clang_disposeTokens(unit, tokens, count)
+        entry.locations = [token.int_data[1] for token in entry.tokens]
+        entry.spellings = [None] * n
+        entry.source_file = None
+        self.lexed += n
+
+
+class _FileTokens(object):
+    __slots__ = ('source_file', 'start', 'limit', 'tokens', 'locations',
+                 'spellings')
+
+    def __init__(self, source_file, start):
+        self.source_file = source_file
+        self.start = start      # raw location of offset 0
+        self.limit = start      # raw location of the last declaration end
+        self.tokens = None      # once lexed, a ctypes array of tokens
+        self.locations = None   # raw location of each token
+        self.spellings = None   # spelling of each token, once needed
+
+
+###############################################################################
+# Interface Functions
+###############################################################################
+
+def token_spellings(cursor):
+    """Return the spellings of the tokens of a cursor, from the token table
+        of its translation unit."""
+    return _table(cursor.translation_unit).spellings(cursor)
+
+
+def token_count(cursor):
+    """Return the number of tokens of a cursor, without spelling them."""
+    return _table(cursor.translation_unit).count(cursor)
+
+
+def forget_tokens(unit):
+    """Drop the token table of a unit (e.g. once it has been reparsed)."""
+    with _lock:
+        _tables.pop(unit, None)
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+_tables = weakref.WeakKeyDictionary()   # TranslationUnit -> TokenTable
+_lock = threading.Lock()
+
+_MACRO_BIT = 1 << 31    # of raw locations, as in clang::SourceLocation
+
+
+def _table(unit):
+    table = _tables.get(unit)
+    if table is None:
+        with _lock:
+            table = _tables.get(unit)
+            if table is None:
+                table = _tables[unit] = TokenTable(unit)
+    return table
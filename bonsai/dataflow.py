@@ -0,0 +1,427 @@
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+###############################################################################
+# Imports
+###############################################################################
+
+from __future__ import unicode_literals
+from builtins import object
+from builtins import range
+
+import heapq
+
+from .cfg import get_cfg
+from .model import (
+    CodeControlFlow, CodeEntity, CodeFunction, CodeOperator, CodeReference,
+    CodeStatement, CodeVariable
+)
+
+
+###############################################################################
+# Dataflow Framework
+###############################################################################
+
+class DataflowProblem(object):
+    """Base class for monotone dataflow problems over a control flow graph.
+
+        Subclasses define the lattice (`initial()`, `boundary()` and
+        `meet()`) and the per-block `transfer()` function. Lattice values
+        are compared with `==`, and must not be mutated in place.
+    """
+
+    def __init__(self, cfg, forward=True):
+        """Constructor for dataflow problems.
+
+        Args:
+            cfg (ControlFlowGraph): The graph to analyse.
+
+        Kwargs:
+            forward (bool): Whether values flow along the edges (from
+                `ENTRY`) or against them (from `EXIT`).
+        """
+        self.cfg = cfg
+        self.forward = forward
+
+    def initial(self):
+        """Return the value all blocks start with (usually the top)."""
+        raise NotImplementedError()
+
+    def boundary(self):
+        """Return the value flowing into `ENTRY` (or out of `EXIT`)."""
+        return self.initial()
+
+    def meet(self, values):
+        """Combine the values of several incoming edges."""
+        raise NotImplementedError()
+
+    def transfer(self, block, value):
+        """Return the value after a block, given the value before it
+            (in the direction of the analysis)."""
+        raise NotImplementedError()
+
+
+class BitsetProblem(DataflowProblem):
+    """A gen/kill problem over a set domain, with sets encoded as integer
+        bitsets. The transfer function is `gen | (value & ~kill)`.
+
+        *May* problems (e.g. reaching definitions, liveness) meet with
+        union and start from the empty set; *must* problems (e.g. available
+        expressions) meet with intersection and start from `universe`.
+    """
+
+    def __init__(self, cfg, gen, kill, forward=True, may=True, universe=0):
+        """Constructor for bitset problems.
+
+        Args:
+            cfg (ControlFlowGraph): The graph to analyse.
+            gen (list): The bitset generated by each block.
+            kill (list): The bitset killed by each block.
+
+        Kwargs:
+            forward (bool): The direction of the analysis.
+            may (bool): Meet with union (True) or intersection (False).
+            universe (int): The bitset with every element; only used
+                by *must* problems.
+        """
+        DataflowProblem.__init__(self, cfg, forward=forward)
+        self.gen = gen
+        self.kill = kill
+        self.may = may
+        self.universe = universe
+
+    def initial(self):
+        return 0 if self.may else self.universe
+
+    def boundary(self):
+        return 0
+
+    def meet(self, values):
+        if self.may:
+            result = 0
+            for value in values:
+                result |= value
+        else:
+            result = self.universe
+            for value in values:
+                result &= value
+        return result
+
+    def transfer(self, block, value):
+        return self.gen[block] | (value & ~self.kill[block])
+
+
+class DataflowResult(object):
+    """The fixpoint of a dataflow problem. `block_in[b]` and `block_out[b]`
+        hold the values at the start and at the end of block `b`,
+        regardless of the direction of the analysis."""
+
+    def __init__(self, block_in, block_out, iterations):
+        self.block_in = block_in
+        self.block_out = block_out
+        self.iterations = iterations
+
+
+###############################################################################
+# Def-Use Chains
+###############################################################################
+
+class DefUseChains(object):
+    """This class holds the def-use and use-def chains of a function.
+
+        A *definition* is any entity that writes a variable: a declared
+        variable (or parameter), an assignment or increment/decrement
+        operator, or, in Python, the assigned name. A *use* is a reference
+        that reads a variable.
+
+        Variables are identified by their entity when references to them
+        are resolved (e.g. C++ locals and members), and by name otherwise
+        (e.g. Python names).
+
+        Definitions and uses are numbered, and the chains are stored as
+        tuples indexed by those numbers, along with indices from entities
+        to numbers. Queries never traverse the program tree.
+
+        NOTE: there is no alias analysis; writes through pointers,
+        references or attributes of other objects are not considered.
+    """
+
+    _INCREMENTS = ('++', '--', '_++', '_--')
+
+    def __init__(self, function):
+        """Constructor for def-use chains.
+
+            Reaching definitions are computed over the function's
+            control flow graph, in a single pass over its statements.
+
+        Args:
+            function (CodeFunction): The function to analyse.
+        """
+        self.function = function
+        self.defs = []          # def number -> entity
+        self.def_keys = []      # def number -> variable (or name)
+        self.stores = []        # def number -> whether a value is written
+        self.uses = []          # use number -> CodeReference
+        self.def_uses = []      # def number -> (use number, ...)
+        self.use_defs = []      # use number -> (def number, ...)
+        self._def_index = {}    # entity -> def number
+        self._use_index = {}    # entity -> use number
+        self._build(get_cfg(function))
+
+    def uses_of(self, definition):
+        """Return the uses that a definition may reach."""
+        d = self._def_index.get(definition)
+        if d is None:
+            return []
+        return [self.uses[u] for u in self.def_uses[d]]
+
+    def defs_reaching(self, reference):
+        """Return the definitions that may reach a use."""
+        u = self._use_index.get(reference)
+        if u is None:
+            return []
+        return [self.defs[d] for d in self.use_defs[u]]
+
+    def dead_stores(self):
+        """Return the definitions of local variables that write a value
+            which is never read afterwards."""
+        dead = []
+        for d in range(len(self.defs)):
+            if self.stores[d] and not self.def_uses[d]:
+                key = self.def_keys[d]
+                if not isinstance(key, CodeVariable) or _is_local(key):
+                    dead.append(self.defs[d])
+        return dead
+
+    def _build(self, cfg):
+        # ----- collect definitions and uses, in evaluation order ------------
+        events = [[] for _ in range(len(cfg.blocks))]
+        start = cfg.block_of(self.function)
+        parameters = self.function.parameters
+        if isinstance(parameters, CodeEntity):
+            parameters = [codeobj for codeobj in parameters.walk_preorder()
+                          if isinstance(codeobj, CodeVariable)]
+        for var in parameters or ():
+            events[start].append(self._new_def(var, _key(var), False))
+        for b in range(len(cfg.blocks)):
+            for codeobj in cfg.blocks[b]:
+                if isinstance(codeobj, CodeControlFlow):
+                    self._scan(codeobj.condition, events[b])
+                else:
+                    self._scan(codeobj, events[b])
+
+        # ----- reaching definitions, with integer bitsets -------------------
+        masks = {}              # variable -> bitset of its definitions
+        for d in range(len(self.defs)):
+            key = self.def_keys[d]
+            masks[key] = masks.get(key, 0) | (1 << d)
+        gen = [0] * len(cfg.blocks)
+        kill = [0] * len(cfg.blocks)
+        for b in range(len(cfg.blocks)):
+            for is_def, key, n in events[b]:
+                if is_def:
+                    kill[b] |= masks[key]
+                    gen[b] = (gen[b] & ~masks[key]) | (1 << n)
+        reach_in = solve_dataflow(BitsetProblem(cfg, gen, kill)).block_in
+
+        # ----- chains -------------------------------------------------------
+        def_uses = [[] for _ in range(len(self.defs))]
+        use_defs = [()] * len(self.uses)
+        for b in range(len(cfg.blocks)):
+            current = reach_in[b]
+            for is_def, key, n in events[b]:
+                if is_def:
+                    current = (current & ~masks[key]) | (1 << n)
+                else:
+                    reaching = _bits(current & masks.get(key, 0))
+                    use_defs[n] = reaching
+                    for d in reaching:
+                        def_uses[d].append(n)
+        self.def_uses = [tuple(uses) for uses in def_uses]
+        self.use_defs = use_defs
+
+    def _new_def(self, codeobj, key, stores):
+        n = len(self.defs)
+        self.defs.append(codeobj)
+        self.def_keys.append(key)
+        self.stores.append(stores)
+        self._def_index[codeobj] = n
+        return (True, key, n)
+
+    def _new_use(self, codeobj, key):
+        n = len(self.uses)
+        self.uses.append(codeobj)
+        self._use_index[codeobj] = n
+        return (False, key, n)
+
+    def _scan(self, codeobj, events):
+        """Append the definitions and uses within an entity to `events`,
+            in evaluation order."""
+        if not isinstance(codeobj, CodeEntity):
+            return
+        if isinstance(codeobj, CodeFunction):
+            return  # nested functions are analysed on their own
+        if isinstance(codeobj, CodeOperator):
+            args = codeobj.arguments
+            if codeobj.is_assignment and len(args) >= 2:
+                self._scan(args[-1], events)
+                for target in args[:-1]:
+                    self._scan_target(target, codeobj, events)
+                return
+            if codeobj.name in self._INCREMENTS and len(args) == 1:
+                self._scan_target(args[0], codeobj, events)
+                return
+        if isinstance(codeobj, CodeVariable):
+            self._scan(codeobj.value, events)
+            events.append(self._new_def(codeobj, _key(codeobj),
+                                        codeobj.value is not None))
+            return
+        if isinstance(codeobj, CodeReference):
+            self._scan(codeobj.field_of, events)
+            key = _reference_key(codeobj)
+            if key is not None:
+                events.append(self._new_use(codeobj, key))
+            return
+        for child in codeobj._children():
+            self._scan(child, events)
+
+    def _scan_target(self, target, operator, events):
+        """Append the definition made by an assignment (or increment) to
+            one of its targets, preceded by the read of the target's old
+            value in compound operators."""
+        compound = operator.name != '='
+        if isinstance(target, CodeReference):
+            key = _reference_key(target)
+            if key is not None:
+                self._scan(target.field_of, events)
+                if compound:
+                    events.append(self._new_use(target, key))
+                events.append(self._new_def(operator, key, True))
+                return
+        elif isinstance(target, CodeVariable):
+            if compound:
+                events.append(self._new_use(target, _key(target)))
+                events.append(self._new_def(operator, _key(target), True))
+            else:
+                events.append(self._new_def(target, _key(target), True))
+            return
+        self._scan(target, events)
+
+
+###############################################################################
+# Interface Functions
+###############################################################################
+
+def solve_dataflow(problem):
+    """Compute the fixpoint of a dataflow problem, and return it as a
+        `DataflowResult`.
+
+        Blocks are processed from a worklist prioritised by reverse
+        postorder (of the reversed graph, for backward problems), so that
+        each block is usually visited after all its inputs, and loops
+        take few passes to stabilise.
+    """
+    cfg = problem.cfg
+    n = len(cfg.blocks)
+    if problem.forward:
+        start, sources, targets = cfg.ENTRY, cfg.predecessors, cfg.successors
+    else:
+        start, sources, targets = cfg.EXIT, cfg.successors, cfg.predecessors
+    order = cfg.reverse_postorder(backward=not problem.forward)
+    rank = [None] * n
+    for i in range(len(order)):
+        rank[order[i]] = i
+    for b in range(n):
+        if rank[b] is None:     # unreachable (from the start)
+            rank[b] = len(order)
+            order.append(b)
+    initial = problem.initial()
+    before = [initial] * n
+    after = [initial] * n
+    worklist = [(rank[b], b) for b in order]    # already a heap
+    queued = [True] * n
+    iterations = 0
+    while worklist:
+        b = heapq.heappop(worklist)[1]
+        queued[b] = False
+        iterations += 1
+        if b == start:
+            value = problem.boundary()
+        elif sources[b]:
+            value = problem.meet(after[p] for p in sources[b])
+        else:
+            value = initial
+        before[b] = value
+        value = problem.transfer(b, value)
+        if value != after[b]:
+            after[b] = value
+            for t in targets[b]:
+                if not queued[t]:
+                    queued[t] = True
+                    heapq.heappush(worklist, (rank[t], t))
+    if problem.forward:
+        return DataflowResult(before, after, iterations)
+    return DataflowResult(after, before, iterations)
+
+
+def get_def_use(function):
+    """Return the `DefUseChains` of a function.
+
+        Chains are built on the first request and cached along with the
+        function's control flow graph (see `bonsai.cfg.invalidate_cfg()`).
+    """
+    cfg = get_cfg(function)
+    chains = getattr(cfg, '_def_use', None)
+    if chains is None:
+        chains = DefUseChains(function)
+        cfg._def_use = chains
+    return chains
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+def _key(var):
+    return var if var.id else var.name
+
+
+def _reference_key(reference):
+    if isinstance(reference.reference, CodeVariable):
+        return _key(reference.reference)
+    if reference.reference is None and reference.field_of is None:
+        return reference.name
+    return None
+
+
+def _is_local(var):
+    # `CodeVariable.is_local` leaves out variables declared at function scope
+    return isinstance(var.scope, (CodeStatement, CodeFunction))
+
+
+def _bits(mask):
+    """Return a tuple with the positions of the bits set in `mask`."""
+    bits = []
+    while mask:
+        low = mask & -mask
+        bits.append(low.bit_length() - 1)
+        mask ^= low
+    return tuple(bits)
@@ -277,6 +277,9 @@ class CodeFunction(CodeEntity, CodeStatementGroup):
 
         If a function is a method of some class, its `member_of` should be
         set to the corresponding class.
+
+        Labelled statements within the function body (targets of `goto`
+        jumps) are kept in `labels`, indexed by label name.
     """
 
     def __init__(self, scope, parent, id, name, result, definition=True):
@@ -297,6 +300,7 @@ class CodeFunction(CodeEntity, CodeStatementGroup):
         self.body = CodeBlock(self, self, explicit=True)
         self.member_of = None
         self.references = []
+        self.labels = {}
         self._definition = self if definition else None
 
     @property
@@ -314,6 +318,11 @@ class CodeFunction(CodeEntity, CodeStatementGroup):
         assert isinstance(codeobj, (CodeStatement, CodeExpression))
         self.body._add(codeobj)
 
+    def _add_label(self, name, statement):
+        """Register a labelled statement (a `goto` target)."""
+        assert isinstance(statement, CodeStatement)
+        self.labels[name] = statement
+
     def _children(self):
         """Yield all direct children of this object."""
         for codeobj in self.parameters:
@@ -1122,7 +1131,8 @@ class CodeJumpStatement(CodeStatement):
     """This class represents a jump statement (e.g. `return`, `break`).
 
         A jump statement has a name. In some cases, it may also have an
-        associated value (e.g. `return 0`).
+        associated value (e.g. `return 0`). For `goto` statements, the value
+        is the name of the target label.
     """
 
     def __init__(self, scope, parent, name):
@@ -1330,6 +1340,17 @@ class CodeControlFlow(CodeStatement, CodeStatementGroup):
         self.name = name
         self.condition = True
         self.body = CodeBlock(scope, self, explicit=False)
+        self._condition_set = False     # True above is just a placeholder
+
+    @property
+    def constant_condition(self):
+        """The value of the condition, if it is a literal constant that
+            was parsed (e.g. `while (1)`), or None otherwise (e.g. for
+            expressions, or conditions that were not built)."""
+        if (not self._condition_set
+                or isinstance(self.condition, CodeExpression)):
+            return None
+        return self.condition
 
     def get_branches(self):
         """Return a list of branches, where each branch is a pair of
@@ -1340,6 +1361,7 @@ class CodeControlFlow(CodeStatement, CodeStatementGroup):
         """Set the condition for this control flow structure."""
         assert isinstance(condition, CodeExpression.TYPES)
         self.condition = condition
+        self._condition_set = True
 
     def _set_body(self, body):
         """Set the main body for this control flow structure."""
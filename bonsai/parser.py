@@ -35,10 +35,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import object
 
+from collections import namedtuple
+import fnmatch
 import logging
+import os
+import re
 import sys
-from functools import partial
+import threading
+import warnings
+from functools import partial, wraps
 
+from .analysis import invalidate_summary
 from .model import (
     CodeExpression, CodeExpressionStatement, CodeVariable, CodeGlobalScope
 )
@@ -209,6 +216,7 @@ class AnalysisData(object):
                 ref.reference = codeobj
             codeobj.references.extend(previous.references)
             previous.references = []
+            _referenced(previous)
         self.entities[codeobj.id] = codeobj
 
         # If the code entity has references before it is added to the AST,
@@ -219,6 +227,7 @@ class AnalysisData(object):
             codeobj.references.extend(references)
             for ref in references:
                 ref.reference = codeobj
+            _referenced(codeobj)
 
             del self._refs[codeobj.id]
 
@@ -238,6 +247,7 @@ class AnalysisData(object):
         # `references` list
         if codeobj is not None:
             codeobj.references.append(ref)
+            _referenced(codeobj)
             referenced = codeobj
 
         # Referenced id not parsed yet, storing reference in self._ref
@@ -251,6 +261,187 @@ class AnalysisData(object):
         ref.reference = referenced
 
 
+Diagnostic = namedtuple("Diagnostic",
+    ("unit", "severity", "file", "line", "column", "message", "category"))
+
+
+class Diagnostics(object):
+    """The diagnostics (errors, warnings...) of parsed units.
+
+        Each is a `Diagnostic`, with the unit (its main file) it comes
+        from, a severity, a location, the message and a category (e.g.
+        "Semantic Issue"). Units whose model was not built, because of
+        their errors, are listed in `skipped`.
+
+        Diagnostics can be added from several threads at once. If a
+        logger is given, each one is also logged as it is added.
+    """
+
+    # severities, as in libclang
+    IGNORED = 0
+    NOTE = 1
+    WARNING = 2
+    ERROR = 3
+    FATAL = 4
+
+    NAMES = ("ignored", "note", "warning", "error", "fatal")
+    LOG_LEVELS = (logging.DEBUG, logging.INFO, logging.WARNING,
+                  logging.ERROR, logging.CRITICAL)
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.skipped = []
+        self._items = []
+        self._lock = threading.Lock()
+
+    def add(self, diagnostic):
+        with self._lock:
+            self._items.append(diagnostic)
+        if self.logger is not None:
+            self.logger.log(self.LOG_LEVELS[diagnostic.severity],
+                            self.format(diagnostic))
+
+    def skip(self, unit):
+        """Record that the model of a unit was not built."""
+        with self._lock:
+            self.skipped.append(unit)
+        if self.logger is not None:
+            self.logger.error("%s: too many errors, model not built", unit)
+
+    def merge(self, other):
+        """Add the diagnostics of another collector (e.g. of a worker)."""
+        for diagnostic in other:
+            self.add(diagnostic)
+        for unit in other.skipped:
+            self.skip(unit)
+
+    def clear(self, unit=None):
+        """Drop all diagnostics, or those of a unit."""
+        with self._lock:
+            if unit is None:
+                self._items = []
+                self.skipped = []
+            else:
+                self._items = [d for d in self._items if d.unit != unit]
+                self.skipped = [u for u in self.skipped if u != unit]
+
+    def query(self, unit=None, severity=None, category=None, file=None):
+        """Return the diagnostics that match all the given filters, in the
+            order they were added.
+
+        Kwargs:
+            unit (str): The main file of the unit.
+            severity (int): The minimum severity.
+            category (str): The category name.
+            file (str): The file of the location.
+        """
+        return [d for d in self
+                if (unit is None or d.unit == unit)
+                and (severity is None or d.severity >= severity)
+                and (category is None or d.category == category)
+                and (file is None or d.file == file)]
+
+    def errors(self, unit=None):
+        """Return the number of errors (of a unit, if given)."""
+        return len(self.query(unit=unit, severity=Diagnostics.ERROR))
+
+    def report(self):
+        """Return a one-line summary of the diagnostics."""
+        items = list(self)
+        errors = sum(1 for d in items if d.severity >= Diagnostics.ERROR)
+        warnings = sum(1 for d in items if d.severity == Diagnostics.WARNING)
+        units = len(set(d.unit for d in items))
+        return ("diagnostics: {} errors, {} warnings, in {} units; "
+                "{} units skipped").format(errors, warnings, units,
+                                           len(self.skipped))
+
+    @classmethod
+    def format(cls, diagnostic):
+        location = ":".join(str(x) for x in (diagnostic.file, diagnostic.line,
+                                             diagnostic.column)
+                            if x is not None)
+        text = "{}: {}".format(cls.NAMES[diagnostic.severity],
+                               diagnostic.message)
+        if diagnostic.category:
+            text += " [{}]".format(diagnostic.category)
+        return "{}: {}".format(location or diagnostic.unit, text)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._items))
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getstate__(self):
+        return (list(self._items), list(self.skipped))
+
+    def __setstate__(self, state):
+        self._items, self.skipped = state
+        self.logger = None
+        self._lock = threading.Lock()
+
+
+class PathFilter(object):
+    """Decide which source files are part of the program model.
+
+        A path is accepted if it is within one of the `roots` (or there
+        are none), matches one of the `include` glob patterns (or there
+        are none), and does not match any of the `exclude` patterns.
+        All three are compiled into a single regular expression, and
+        each decision is cached by path, so repeated queries (e.g. once
+        per top-level cursor of a unit) cost a dictionary lookup.
+
+        Paths are matched as given; callers normalize them if needed.
+    """
+
+    def __init__(self, roots=(), include=None, exclude=None):
+        """Constructor for path filters.
+
+        Kwargs:
+            roots (list): Directories (or path prefixes) to accept files
+                from. An empty root accepts every file.
+            include (list): Glob patterns of files to accept.
+            exclude (list): Glob patterns of files to reject.
+        """
+        self.roots = [root for root in roots if root is not None]
+        self.include = list(include or ())
+        self.exclude = list(exclude or ())
+        self._regex = self._compile(self.roots, self.include, self.exclude)
+        self._cache = {}
+
+    def __call__(self, file_path):
+        """Return whether a file is accepted by the filter."""
+        accepted = self._cache.get(file_path)
+        if accepted is None:
+            accepted = self._cache[file_path] = (
+                self._regex is None
+                or self._regex.match(file_path) is not None)
+        return accepted
+
+    def __getstate__(self):
+        return (self.roots, self.include, self.exclude)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @staticmethod
+    def _compile(roots, include, exclude):
+        parts = []
+        if exclude:
+            parts.append("(?!{})".format("|".join(fnmatch.translate(p)
+                                                  for p in exclude)))
+        if include:
+            parts.append("(?={})".format("|".join(fnmatch.translate(p)
+                                                  for p in include)))
+        if roots and all(roots):
+            # a root is a whole directory, not a prefix of names within it
+            parts.append("(?:{})(?:{}|\\Z)".format(
+                "|".join(re.escape(root.rstrip(os.sep)) for root in roots),
+                re.escape(os.sep)))
+        return re.compile("".join(parts)) if parts else None
+
+
 class CodeAstParser(object):
     class LoggerStream(object):
         def __init__(self, logger, stream, log_level=None):
@@ -266,42 +457,53 @@ class CodeAstParser(object):
 
     @classmethod
     def with_logger(cls, parse_fn):
-        def wrapper(*args, **kwargs):
-            self = args[0]
+        """Deprecated: parsers collect compiler output in `diagnostics`,
+            logged to `logger` as it comes. For parsers that still print,
+            this echoes stdout and stderr to `logger` during `parse_fn`.
 
+            NOTE: this swaps `sys.stdout` and `sys.stderr`, which is not
+            safe with parser threads.
+        """
+        warnings.warn("CodeAstParser.with_logger is deprecated; use the "
+                      "parser's logger and diagnostics instead",
+                      DeprecationWarning, stacklevel=2)
+        @wraps(parse_fn)
+        def wrapper(self, *args, **kwargs):
             if not self.has_logger:
-                return parse_fn(*args, **kwargs)
-
-            sys.stdout = self.stdout_logger
-            sys.stderr = self.stderr_logger
-
-            ret = parse_fn(*args, **kwargs)
-
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
-
-            return ret
-
+                return parse_fn(self, *args, **kwargs)
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = cls.LoggerStream(self.logger, sys.__stdout__)
+            sys.stderr = cls.LoggerStream(self.logger, sys.__stderr__,
+                                          logging.ERROR)
+            try:
+                return parse_fn(self, *args, **kwargs)
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
         return wrapper
 
     def __init__(self, workspace='', logger=None):
         self.workspace      = workspace
         self.global_scope   = CodeGlobalScope()
         self.data           = AnalysisData()
-
-        if logger is not None:
-            logger = logging.getLogger(logger)
-            self.stdout_logger = self.LoggerStream(logger, sys.__stdout__)
-            self.stderr_logger = self.LoggerStream(logger, sys.__stderr__,
-                                                   logging.ERROR)
-        else:
-            self.stdout_logger = None
-            self.stderr_logger = None
+        self.logger         = (logging.getLogger(logger)
+                               if logger is not None else None)
+        # compiler diagnostics, collected (and logged) per unit
+        self.diagnostics    = Diagnostics(self.logger)
 
     @property
     def has_logger(self):
-        return (self.stdout_logger is not None
-                and self.stderr_logger is not None)
+        return self.logger is not None
 
     def parse(self, file_path):
         return self.global_scope
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+def _referenced(codeobj):
+    """Discard what was derived from the references to an entity (i.e. its
+        parameter summary, and those built from it) when it gets new ones."""
+    if getattr(codeobj, "_summary", None) is not None:
+        invalidate_summary(codeobj)
@@ -38,6 +38,7 @@ from itertools import takewhile
 from os import path
 
 from bonsai.analysis import CodeQuery
+from bonsai.parser import PathFilter
 from bonsai.py.model import PyGlobalScope
 from bonsai.py.visitor import ASTPreprocessor, BuilderVisitor
 
@@ -47,9 +48,11 @@ from bonsai.py.visitor import ASTPreprocessor, BuilderVisitor
 
 
 class FileFinder(object):
-    def __init__(self, parser, pythonpath=None, workspace=''):
+    def __init__(self, parser, pythonpath=None, workspace='', include=None,
+                 exclude=None):
         self.parser = parser
         self.workspace = workspace
+        self.path_filter = PathFilter((workspace,), include, exclude)
         self.pythonpath = list(filter(self.is_in_workspace,
                                       (pythonpath or []) + sys.path))
         self.top_level = {}
@@ -130,7 +133,7 @@ class FileFinder(object):
         return top_level_names
 
     def is_in_workspace(self, file_path):
-        return file_path and file_path.startswith(self.workspace)
+        return bool(file_path) and self.path_filter(file_path)
 
     def make_absolute(self, importing_path, imported_module):
         leading_dots = ''.join(takewhile(lambda c: c == '.',
@@ -207,9 +210,11 @@ class PyAstParser(object):
             self.imported_names_list.append(i)
         return node, imported_names
 
-    def __init__(self, pythonpath=None, workspace=''):
+    def __init__(self, pythonpath=None, workspace='', include=None,
+                 exclude=None):
         self.global_scope = PyGlobalScope()
-        self.file_finder = FileFinder(self, pythonpath, workspace)
+        self.file_finder = FileFinder(self, pythonpath, workspace,
+                                      include=include, exclude=exclude)
         self.imported_names_list = []
         self.cache = {}
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Checks that sharded runs over the C++ examples, once merged, build the same
+# model as single runs, and that checkouts at different places agree on how
+# to shard. Exits with status 1 if any check fails.
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import range
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from bonsai.cpp.clang_parser import CppAstParser
+from bonsai.cpp import shards
+
+# ----- Setup ------------------------------------------------------------------
+parser = argparse.ArgumentParser(prog="shards_check")
+parser.add_argument("-v", "--version", default="3.8",
+                    help="LLVM version (default: 3.8)")
+parser.add_argument("-l", "--lib-path", help="libclang directory")
+parser.add_argument("-s", "--std-includes", help="standard include path")
+parser.add_argument("-n", "--shards", type=int, default=4,
+                    help="check 1 to N shards (default: 4)")
+args = parser.parse_args()
+CppAstParser.set_library_path(
+    args.lib_path or "/usr/lib/llvm-{v}/lib".format(v=args.version))
+CppAstParser.set_standard_includes(args.std_includes or
+    "/usr/lib/llvm-{v}/lib/clang/{v}.0/include".format(v=args.version))
+
+def make_checkout(examples):
+    """Copy the examples somewhere new, with a compilation database."""
+    root = os.path.join(tempfile.mkdtemp(prefix="bonsai-check-"), "cpp")
+    shutil.copytree(examples, root)
+    commands = []
+    for directory, _, files in sorted(os.walk(root)):
+        for name in sorted(files):
+            if name.endswith(".cpp"):
+                commands.append({"directory": directory, "file": name,
+                                 "arguments": ["clang++", "-std=c++11",
+                                               "-c", name]})
+    with io.open(os.path.join(root, "compile_commands.json"), "w") as handle:
+        handle.write(json.dumps(commands, indent=1))
+    return root
+
+examples = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "examples", "cpp")
+roots = [make_checkout(examples), make_checkout(examples)]
+failures = 0
+# ----- Merged Shards ----------------------------------------------------------
+CppAstParser.set_database(roots[0])
+for headers_once in (False, True):
+    make_parser = lambda: CppAstParser(workspace=roots[0],
+                                       headers_once=headers_once)
+    for by in shards.METHODS:
+        for count in range(1, args.shards + 1):
+            _, _, line = shards.simulate(make_parser, count, by=by)
+            print("[{}]".format("OK" if line is None else "FAIL"),
+                  "{} shards by {}{}".format(count, by,
+                  ", headers once" if headers_once else ""))
+            if line is not None:
+                print("    first difference:", line)
+                failures += 1
+# ----- Partitions Across Checkouts --------------------------------------------
+partitions = []
+for root in roots:
+    CppAstParser.set_database(root)
+    commands = CppAstParser(workspace=root).database_commands()
+    partitions.append([[os.path.relpath(shards._source(command), root)
+                        for _, command in shards.select_shard(
+                            commands, i, count, by=by, root=root)]
+                       for by in shards.METHODS
+                       for count in range(1, args.shards + 1)
+                       for i in range(count)])
+same = partitions[0] == partitions[1]
+print("[{}]".format("OK" if same else "FAIL"),
+      "same shards for checkouts at different places")
+failures += not same
+# ----- Cleanup ----------------------------------------------------------------
+for root in roots:
+    shutil.rmtree(os.path.dirname(root), ignore_errors=True)
+sys.exit(1 if failures else 0)